@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from .fakesmtp import FakeSMTPServer
+
+"""This module benchmarks the checker end to end without touching the network.
+It starts a local HTTP target (see faketarget) in its own process and a fake SMTP
+sink, seeds a scratch SQLite database with thousands of check definitions and then
+runs the real startup, scheduler, check, alerting and result writing code against
+them while polling /latestresults. Run it from the repository root:
+
+    python -m benchmarks.benchmark --checks 5000 --frequency 10 --duration 60
+
+Settings the app reads from the environment (MAX_CONCURRENT_CHECKS and so on) are
+honoured, so the effect of tuning them can be measured"""
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(values: list, share: float):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(share * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+def summarise(values: list, scale: float = 1) -> dict:
+    return {name: None if percentile(values, share) is None
+            else round(percentile(values, share) * scale, 2)
+            for name, share in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1))}
+
+def peak_rss_mb() -> float:
+    # linux reports ru_maxrss in kilobytes, macOS in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def prepare_environment(args, workdir: str):
+    """Points the app at the scratch directory and the stand-in servers. Anything
+    already set in the environment wins, apart from the mail server address."""
+    build_directory = os.path.join(workdir, 'build')
+    os.makedirs(os.path.join(build_directory, 'static'), exist_ok=True)
+    defaults = {
+        'ADMIN_EMAIL': 'admin@example.com',
+        'SENDER_EMAIL': 'checker@example.com',
+        'SMTP_USERNAME': 'benchmark',
+        'SMTP_PASSWORD': 'benchmark',
+        'BUILD_DIRECTORY': build_directory,
+        'DATABASE_URL': 'sqlite+aiosqlite:///{}'.format(os.path.join(workdir, 'urlchecker.db')),
+        # every check hits the same target host, so don't let the per-host limit
+        # become the thing being measured
+        'HTTP_PER_HOST_CONNECTIONS': os.environ.get('MAX_CONCURRENT_CHECKS', '100'),
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    os.environ.update({'SMTP_SERVER': '127.0.0.1', 'SMTP_PORT': str(args.smtp_port),
+                       'SMTP_USE_TLS': 'false', 'DROP_ALL': 'false'})
+    os.chdir(workdir)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+
+async def start_target(args):
+    command = [sys.executable, '-m', 'benchmarks.faketarget', '--port', str(args.http_port),
+               '--latency', str(args.latency), '--latency-jitter', str(args.latency_jitter),
+               '--body-size', str(args.body_size), '--failure-rate', str(args.failure_rate),
+               '--hang-rate', str(args.hang_rate)]
+    process = await asyncio.create_subprocess_exec(*command, cwd=REPO_ROOT,
+                                                   stdout=asyncio.subprocess.PIPE)
+    # wait for the target to say it's listening before any check runs
+    await process.stdout.readline()
+    return process
+
+async def seed_definitions(args):
+    from sqlalchemy import insert
+    from core import database, models, migrations
+    async with database.engine.begin() as conn:
+        await conn.run_sync(migrations.drop_schema)
+        await conn.run_sync(migrations.run_migrations)
+    definitions, addresses = [], []
+    for i in range(1, args.checks + 1):
+        definitions.append({
+            'id': i,
+            'url': 'http://127.0.0.1:{}/check/{}'.format(args.http_port, i),
+            'frequency': args.frequency,
+            'expectedStatus': 200,
+            'expectedString': 'world' if i % 100 < args.expected_string_share * 100 else None
+        })
+        if i % 100 < args.alert_share * 100:
+            addresses.append({'checkId': i, 'emailAddress': 'owner{}@example.com'.format(i)})
+    async with database.OrmSession() as session:
+        await session.execute(insert(models.CheckDefinition), definitions)
+        if addresses:
+            await session.execute(insert(models.NotificationAddress), addresses)
+        await session.commit()
+
+async def poll_latest_results(app, interval: float, latencies: list):
+    import httpx
+    headers = {'api_key': os.environ.get('API_KEY', 'supersecretkey123')}
+    async with httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+        while True:
+            started = time.perf_counter()
+            response = await client.get('/latestresults', headers=headers,
+                                        params={'_start': 0, '_end': 50, '_sort': 'id'})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(interval)
+
+async def interval_drift(frequency: int) -> list:
+    """How far apart consecutive runs of each check really were, compared with
+    its frequency. This is schedule drift as seen in the stored results."""
+    from sqlalchemy import select
+    from core import database, models
+    drift, previous = [], {}
+    async with database.OrmSession() as session:
+        rows = await session.stream(select(models.CheckResult.checkId,
+                                           models.CheckResult.timeChecked)
+                                    .order_by(models.CheckResult.checkId,
+                                              models.CheckResult.timeChecked))
+        async for checkId, timeChecked in rows:
+            last = previous.get(checkId)
+            if last is not None:
+                drift.append(abs((timeChecked - last).total_seconds() - frequency))
+            previous[checkId] = timeChecked
+    return drift
+
+def histogram_mean(histogram) -> float:
+    total, count = histogram.total()
+    return total / count if count else 0
+
+async def run(args) -> dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix='urlchecker-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    prepare_environment(args, workdir)
+    target = await start_target(args)
+    smtp = await FakeSMTPServer(port=args.smtp_port).start()
+    try:
+        import main
+        from core import metrics
+        await seed_definitions(args)
+
+        started = time.perf_counter()
+        await main.initialize_data_and_jobs()
+        startup_seconds = time.perf_counter() - started
+
+        api_latencies = []
+        poller = asyncio.create_task(poll_latest_results(main.app, args.api_interval,
+                                                         api_latencies))
+        started = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        poller.cancel()
+        await main.stop_jobs()
+        elapsed = time.perf_counter() - started
+
+        checks = metrics.checks_total.total()
+        written = metrics.results_written.total()
+        write_seconds = metrics.db_write_duration.total()[0]
+        drift = await interval_drift(args.frequency)
+        return {
+            'checks': args.checks,
+            'frequency_seconds': args.frequency,
+            'duration_seconds': round(elapsed, 1),
+            'startup_seconds': round(startup_seconds, 2),
+            'checks_completed': int(checks),
+            'checks_per_second': round(checks / elapsed, 1),
+            'check_errors': int(metrics.check_errors.total()),
+            'expected_checks_per_second': round(args.checks / args.frequency, 1),
+            'schedule_lag_mean_ms': round(histogram_mean(metrics.schedule_lag) * 1000, 2),
+            'interval_drift_ms': summarise(drift, 1000),
+            'results_written': int(written),
+            'db_rows_per_write_second': round(written / write_seconds) if write_seconds else None,
+            'db_write_batch_mean_ms': round(histogram_mean(metrics.db_write_duration) * 1000, 2),
+            'latestresults_requests': len(api_latencies),
+            'latestresults_latency_ms': summarise(api_latencies, 1000),
+            'alerts_delivered': len(smtp.messages),
+            'event_loop_lag_ms': round(metrics.event_loop_lag.get() * 1000, 2),
+            'peak_rss_mb': peak_rss_mb(),
+            'workdir': workdir
+        }
+    finally:
+        await smtp.stop()
+        target.terminate()
+        await target.wait()
+
+def print_report(report: dict):
+    width = max(len(name) for name in report)
+    for name, value in report.items():
+        if isinstance(value, dict):
+            value = '  '.join('{}={}'.format(k, v) for k, v in value.items())
+        print('{}  {}'.format(name.ljust(width), value))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the URL checker offline')
+    parser.add_argument('--checks', type=int, default=2000, help='check definitions to load')
+    parser.add_argument('--frequency', type=int, default=10, help='seconds between runs of each check')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to measure for')
+    parser.add_argument('--latency', type=float, default=0.01, help='target response time in seconds')
+    parser.add_argument('--latency-jitter', type=float, default=0.02)
+    parser.add_argument('--body-size', type=int, default=2048, help='target response body bytes')
+    parser.add_argument('--failure-rate', type=float, default=0.02,
+                        help='share of target responses that are 500s')
+    parser.add_argument('--hang-rate', type=float, default=0,
+                        help='share of target requests that are never answered')
+    parser.add_argument('--expected-string-share', type=float, default=0.2,
+                        help='share of checks that also search the body')
+    parser.add_argument('--alert-share', type=float, default=0.1,
+                        help='share of checks with a notification address')
+    parser.add_argument('--api-interval', type=float, default=0.25,
+                        help='seconds between /latestresults requests')
+    parser.add_argument('--http-port', type=int, default=8765)
+    parser.add_argument('--smtp-port', type=int, default=2525)
+    parser.add_argument('--workdir', help='where to put the scratch database, a temp dir by default')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
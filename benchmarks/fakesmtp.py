@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import base64
+from email import message_from_bytes
+
+"""This module is a minimal SMTP server that accepts and keeps every message it's
+sent. It speaks just enough of the protocol for aiosmtplib (EHLO, AUTH PLAIN/LOGIN,
+MAIL, RCPT, DATA), so alerting can be exercised offline by pointing SMTP_SERVER and
+SMTP_PORT at it with SMTP_USE_TLS=false"""
+
+class FakeSMTPServer:
+    """Collects delivered messages in `messages`. A `delay` slows every reply down
+    and a non-zero `fail_every` rejects every n-th message, which is useful for
+    exercising retries and slow mail servers."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 2525,
+                 delay: float = 0, fail_every: int = 0):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.fail_every = fail_every
+        self.messages = []
+        self.connections = 0
+        self._received = 0
+        self._server = None
+
+    async def _reply(self, writer, line: str):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        writer.write(line.encode() + b'\r\n')
+        await writer.drain()
+
+    async def _read_data(self, reader):
+        lines = []
+        while True:
+            line = await reader.readline()
+            if not line or line == b'.\r\n':
+                break
+            # undo the dot-stuffing clients apply to lines starting with '.'
+            lines.append(line[1:] if line.startswith(b'..') else line)
+        return b''.join(lines)
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        sender, recipients = None, []
+        await self._reply(writer, '220 fakesmtp ready')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors='replace').strip()
+                verb = command.split(' ', 1)[0].upper()
+                if verb == 'EHLO':
+                    await self._reply(writer, '250-fakesmtp\r\n250-AUTH PLAIN LOGIN\r\n250 OK')
+                elif verb == 'HELO':
+                    await self._reply(writer, '250 fakesmtp')
+                elif verb == 'AUTH':
+                    mechanism = command.split(' ')[1].upper()
+                    if mechanism == 'LOGIN':
+                        await self._reply(writer, '334 ' + base64.b64encode(b'Username:').decode())
+                        await reader.readline()
+                        await self._reply(writer, '334 ' + base64.b64encode(b'Password:').decode())
+                        await reader.readline()
+                    elif len(command.split(' ')) < 3:
+                        await self._reply(writer, '334 ')
+                        await reader.readline()
+                    await self._reply(writer, '235 Authentication successful')
+                elif verb == 'MAIL':
+                    sender, recipients = command.split(':', 1)[1].strip(), []
+                    await self._reply(writer, '250 OK')
+                elif verb == 'RCPT':
+                    recipients.append(command.split(':', 1)[1].strip().strip('<>'))
+                    await self._reply(writer, '250 OK')
+                elif verb == 'DATA':
+                    await self._reply(writer, '354 End data with <CR><LF>.<CR><LF>')
+                    data = await self._read_data(reader)
+                    self._received += 1
+                    if self.fail_every and self._received % self.fail_every == 0:
+                        await self._reply(writer, '451 Requested action aborted')
+                    else:
+                        self.messages.append((sender, recipients, message_from_bytes(data)))
+                        await self._reply(writer, '250 OK')
+                elif verb in ('RSET', 'NOOP'):
+                    await self._reply(writer, '250 OK')
+                elif verb == 'QUIT':
+                    await self._reply(writer, '221 Bye')
+                    break
+                else:
+                    await self._reply(writer, '502 Command not implemented')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+async def serve(host: str, port: int):
+    server = FakeSMTPServer(host, port)
+    await server.start()
+    print('Fake SMTP server listening on {}:{}'.format(host, port))
+    seen = 0
+    while True:
+        await asyncio.sleep(1)
+        for sender, recipients, message in server.messages[seen:]:
+            print('{} -> {}: {}'.format(sender, ', '.join(recipients), message['Subject']))
+        seen = len(server.messages)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local SMTP sink')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
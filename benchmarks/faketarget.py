@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import random
+from urllib.parse import urlsplit, parse_qsl
+
+"""This module is a minimal HTTP/1.1 server to point URL checks at. How it answers
+is tunable for the whole server and per request through the query string, so one
+target can stand in for fast, slow, failing, large and unresponsive endpoints:
+
+    /anything?latency=0.2&status=503&size=4096&hang=1
+
+Connections are kept alive between requests like a typical web server would"""
+
+REASONS = {200: 'OK', 204: 'No Content', 301: 'Moved Permanently',
+           404: 'Not Found', 500: 'Internal Server Error',
+           502: 'Bad Gateway', 503: 'Service Unavailable'}
+
+class FakeHTTPTarget:
+    """Answers every request after `latency` seconds (plus up to `latency_jitter`
+    more) with a body of `body_size` bytes. Responses fail with `failure_status`
+    at `failure_rate` and never get answered at `hang_rate`."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765,
+                 latency: float = 0, latency_jitter: float = 0,
+                 body_size: int = 1024, status: int = 200,
+                 failure_rate: float = 0, failure_status: int = 500,
+                 hang_rate: float = 0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.body_size = body_size
+        self.status = status
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.hang_rate = hang_rate
+        self.requests = 0
+        self.connections = 0
+        self._bodies = {}
+        self._server = None
+
+    def _body(self, size: int) -> bytes:
+        # bodies are cached by size, they're the same text over and over anyway
+        body = self._bodies.get(size)
+        if body is None:
+            body = self._bodies[size] = (b'hello world ' * (size // 12 + 1))[:size]
+        return body
+
+    def _plan(self, target: str):
+        """Works out latency, status, body size and whether to hang for a request"""
+        options = dict(parse_qsl(urlsplit(target).query))
+        latency = float(options.get('latency', self.latency))
+        latency += random.uniform(0, self.latency_jitter)
+        status = int(options.get('status', self.status))
+        if status == self.status and random.random() < self.failure_rate:
+            status = self.failure_status
+        size = int(options.get('size', self.body_size))
+        hang = options.get('hang') == '1' or random.random() < self.hang_rate
+        return latency, status, size, hang
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None, None, None
+        content_length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                content_length = int(value.strip())
+        if content_length:
+            await reader.readexactly(content_length)
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        return method, target, request_line
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                method, target, request_line = await self._read_request(reader)
+                if request_line is None:
+                    break
+                self.requests += 1
+                latency, status, size, hang = self._plan(target)
+                if hang:
+                    # hold the connection open without answering until the client gives up
+                    await reader.read()
+                    break
+                if latency:
+                    await asyncio.sleep(latency)
+                body = self._body(size)
+                head = 'HTTP/1.1 {} {}\r\nContent-Type: text/plain\r\nContent-Length: {}\r\n\r\n'.format(
+                    status, REASONS.get(status, 'Unknown'), len(body))
+                writer.write(head.encode() + (b'' if method == 'HEAD' else body))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port,
+                                                  backlog=1024)
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+async def serve(**options):
+    server = FakeHTTPTarget(**options)
+    await server.start()
+    print('Fake HTTP target listening on {}:{}'.format(server.host, server.port), flush=True)
+    await asyncio.Event().wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local HTTP target for URL checks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help='seconds before answering')
+    parser.add_argument('--latency-jitter', type=float, default=0,
+                        help='up to this many extra seconds, picked at random per request')
+    parser.add_argument('--body-size', type=int, default=1024, help='response body bytes')
+    parser.add_argument('--status', type=int, default=200)
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='share of responses answered with --failure-status')
+    parser.add_argument('--failure-status', type=int, default=500)
+    parser.add_argument('--hang-rate', type=float, default=0,
+                        help='share of requests that are never answered')
+    args = parser.parse_args()
+    asyncio.run(serve(**vars(args)))
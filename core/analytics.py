@@ -0,0 +1,164 @@
+import calendar
+import json
+from collections import Counter
+from datetime import datetime, timedelta
+from . import database, crud, validations, retention
+
+"""This module is responsible for uptime and latency reports. They're built from
+the hourly and daily rollups, plus the few raw results written since the last
+roll up pass, which the database groups before they're read. Reports therefore
+cost about the same however much history they cover"""
+
+PERCENTILES = (50, 95, 99)
+
+class Aggregate:
+    """Running totals for one check over one bucket (or the whole window). Latency
+    percentiles come from a histogram, so they're within about 10% of exact."""
+    __slots__ = ('count', 'failures', 'status_codes', 'latency_count', 'latency_sum',
+                 'latency_min', 'latency_max', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.status_codes = Counter()
+        self.latency_count = 0
+        self.latency_sum = 0
+        self.latency_min = None
+        self.latency_max = None
+        self.histogram = Counter()
+
+    def add(self, count: int, failures: int, status_codes: dict, latency_count: int,
+            latency_sum: int, latency_min: int, latency_max: int):
+        self.count += count
+        self.failures += failures
+        self.status_codes.update(status_codes)
+        if latency_count:
+            self.latency_count += latency_count
+            self.latency_sum += latency_sum
+            self.latency_min = (latency_min if self.latency_min is None
+                                else min(self.latency_min, latency_min))
+            self.latency_max = (latency_max if self.latency_max is None
+                                else max(self.latency_max, latency_max))
+
+    def percentile(self, p: int):
+        """The nearest rank percentile, read as the upper bound of its histogram
+        bucket and kept within the observed minimum and maximum"""
+        total = sum(self.histogram.values())
+        if not total:
+            return None
+        rank = -(-total * p // 100)
+        seen = 0
+        # rollups keep their histogram keys as strings, so they're only decoded here
+        for bound, count in sorted((int(k), v) for k, v in self.histogram.items()):
+            seen += count
+            if seen >= rank:
+                return max(min(bound, self.latency_max), self.latency_min)
+
+    def stats(self, start: datetime, end: datetime) -> dict:
+        return {
+            'start': start,
+            'end': end,
+            'count': self.count,
+            'failures': self.failures,
+            'uptimePercent': (round(100 * (self.count - self.failures) / self.count, 3)
+                              if self.count else None),
+            'statusCodes': dict(self.status_codes),
+            'latencyMeanMs': (round(self.latency_sum / self.latency_count, 1)
+                              if self.latency_count else None),
+            'latencyMinMs': self.latency_min,
+            'latencyMaxMs': self.latency_max,
+            'latencyP50Ms': self.percentile(50),
+            'latencyP95Ms': self.percentile(95),
+            'latencyP99Ms': self.percentile(99)
+        }
+
+def epoch(moment: datetime) -> int:
+    # stored timestamps are naive, so they're read as UTC on both sides
+    return calendar.timegm(moment.timetuple())
+
+def rollup_periods(since: datetime, until: datetime, now: datetime,
+                   bucket_seconds: int = None):
+    """Splits the window between the rollup periods. Every result is in both an
+    hourly and a daily rollup, and hourly ones are pruned sooner, so days the
+    hourly rollups may no longer fully cover are read from the daily ones. When
+    buckets are at least a day wide, whole days are read from the daily rollups
+    too, which is a 24th of the rows."""
+    hourly_cutoff = now - retention.result_compactor.hourly_retention
+    boundary = retention.PERIODS['day'](hourly_cutoff) + timedelta(days=1)
+    day_start, day_end = since, boundary
+    if not bucket_seconds or bucket_seconds >= 86400:
+        first_day = retention.PERIODS['day'](since)
+        if first_day < since:
+            first_day += timedelta(days=1)
+        last_day = max(retention.PERIODS['day'](until), first_day)
+        if since >= boundary:
+            day_start = first_day
+        day_end = max(last_day, boundary)
+    periods = []
+    if since < day_start:
+        periods.append(('hour', since, min(day_start, until)))
+    if day_start < min(day_end, until):
+        periods.append(('day', day_start, min(day_end, until)))
+    if until > day_end:
+        periods.append(('hour', max(since, day_end), until))
+    return periods
+
+def bucket_total(since: datetime, until: datetime, bucket_seconds: int = None) -> int:
+    if not bucket_seconds:
+        return 0
+    return -(-int((until - since).total_seconds()) // bucket_seconds)
+
+async def get_analytics(session: database.AsyncSession, checkIds: list[int],
+                        since: datetime, until: datetime,
+                        bucket_seconds: int = None) -> list[validations.CheckAnalytics]:
+    """Uptime, status codes and latency per check over [since, until), and also
+    per `bucket_seconds` wide bucket when given. Rolled up results are placed by
+    the start of their hour (or day, once hourly rollups are pruned), so window
+    edges and buckets are only that precise."""
+    since_epoch = epoch(since)
+    totals = {checkId: Aggregate() for checkId in checkIds}
+    buckets = {checkId: {} for checkId in checkIds}
+
+    def aggregates_for(checkId: int, bucket: int):
+        yield totals[checkId]
+        if bucket_seconds:
+            aggregate = buckets[checkId].get(bucket)
+            if aggregate is None:
+                aggregate = buckets[checkId][bucket] = Aggregate()
+            yield aggregate
+
+    # everything up to the watermark is in the rollups, everything after is raw
+    watermark = await crud.get_rollup_watermark(session)
+    for period, start, end in rollup_periods(since, until, datetime.now(),
+                                                     bucket_seconds):
+        for row in await crud.get_rollup_aggregates(session, checkIds, period, start, end,
+                                                    since_epoch, bucket_seconds):
+            status_codes = json.loads(row.statusCodes or '{}')
+            histogram = json.loads(row.latencyHistogram or '{}')
+            for aggregate in aggregates_for(row.checkId, row.bucket):
+                aggregate.add(row.count, row.failures, status_codes, row.latencyCount,
+                              row.latencySum, row.latencyMin, row.latencyMax)
+                aggregate.histogram.update(histogram)
+    for row in await crud.get_result_aggregates(session, checkIds, since, until, watermark,
+                                                since_epoch, bucket_seconds):
+        for aggregate in aggregates_for(row.checkId, row.bucket):
+            aggregate.add(row.count, row.failures, {str(row.statusCode): row.count},
+                          row.latencyCount, row.latencySum, row.latencyMin, row.latencyMax)
+    for row in await crud.get_latency_counts(session, checkIds, since, until, watermark,
+                                             since_epoch, bucket_seconds):
+        bound = retention.latency_bound(row.latencyMs)
+        for aggregate in aggregates_for(row.checkId, row.bucket):
+            aggregate.histogram[str(bound)] += row.count
+
+    bucket_count = bucket_total(since, until, bucket_seconds)
+    reports = []
+    for checkId in checkIds:
+        report = validations.CheckAnalytics(checkId=checkId,
+                                            **totals[checkId].stats(since, until))
+        for index in range(bucket_count):
+            start = since + timedelta(seconds=index * bucket_seconds)
+            end = min(start + timedelta(seconds=bucket_seconds), until)
+            aggregate = buckets[checkId].get(index) or Aggregate()
+            report.buckets.append(validations.UptimeStats(**aggregate.stats(start, end)))
+        reports.append(report)
+    return reports
@@ -0,0 +1,112 @@
+import asyncio
+import json
+from typing import List, Optional
+from . import validations, metrics
+
+"""This module is responsible for pushing check results to live subscribers, like
+open dashboards, as they're produced. Every result is encoded once and handed to
+each interested subscriber's own bounded buffer, so subscribers cost memory but
+no database queries, and a subscriber that stops reading is dropped instead of
+holding anything else up"""
+
+settings = validations.EnvironmentSettings()
+
+class Subscription:
+    """One subscriber's filters and buffer. Empty filters match everything."""
+    __slots__ = ('checkIds', 'states', 'changes_only', 'queue')
+
+    def __init__(self, checkIds: Optional[List[int]], states: Optional[List[str]],
+                 changes_only: bool, buffer_size: int):
+        self.checkIds = set(checkIds) if checkIds else None
+        self.states = set(states) if states else None
+        self.changes_only = changes_only
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+
+    def matches(self, checkId: int, state: str, changed: bool) -> bool:
+        return ((self.checkIds is None or checkId in self.checkIds)
+                and (self.states is None or state in self.states)
+                and (changed or not self.changes_only))
+
+class ResultBroadcaster:
+    """Fans results out to subscribers. The last state of every check is kept so
+    state changes can be flagged, which is all the history this needs."""
+
+    def __init__(self, buffer_size: int, max_subscribers: int):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._subscriptions = set()
+        self._last_states = {}
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self, checkIds: List[int] = None, states: List[str] = None,
+                  changes_only: bool = False) -> Optional[Subscription]:
+        """Returns None when there are already `max_subscribers` subscribers"""
+        if len(self._subscriptions) >= self.max_subscribers:
+            return None
+        subscription = Subscription(checkIds, states, changes_only, self.buffer_size)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscriptions.discard(subscription)
+
+    def _drop(self, subscription: Subscription):
+        # make room for the sentinel that tells the subscriber it was dropped
+        self.unsubscribe(subscription)
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
+        metrics.live_subscribers_dropped.inc()
+
+    def forget(self, checkId: int):
+        self._last_states.pop(checkId, None)
+
+    def publish(self, check_result: validations.CheckResultBase):
+        previous_state = self._last_states.get(check_result.checkId)
+        self._last_states[check_result.checkId] = check_result.state
+        if not self._subscriptions:
+            return
+        changed = previous_state != check_result.state
+        event = None
+        for subscription in list(self._subscriptions):
+            if not subscription.matches(check_result.checkId, check_result.state, changed):
+                continue
+            if event is None:
+                data = dict(check_result.dict(), previousState=previous_state,
+                            timeChecked=check_result.timeChecked.isoformat())
+                event = encode_event('statechange' if changed else 'result', data)
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._drop(subscription)
+
+    async def events(self, subscription: Subscription, keepalive: float):
+        """Yields encoded events for one subscriber until it's dropped. A comment
+        line goes out when nothing has been sent for `keepalive` seconds, which keeps
+        proxies from closing the stream and lets us notice closed connections."""
+        try:
+            yield b'retry: 5000\n\n'
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield b': keepalive\n\n'
+                    continue
+                if event is None:
+                    yield encode_event('dropped', {'reason': 'subscriber fell behind'})
+                    return
+                yield event
+        finally:
+            self.unsubscribe(subscription)
+
+def encode_event(name: str, data: dict) -> bytes:
+    # server-sent events framing, see https://html.spec.whatwg.org/multipage/server-sent-events.html
+    return 'event: {}\ndata: {}\n\n'.format(name, json.dumps(data)).encode()
+
+result_broadcaster = ResultBroadcaster(buffer_size=settings.live_buffer_size,
+                                       max_subscribers=settings.live_max_subscribers)
+
+metrics.Gauge('urlchecker_live_subscribers', 'Open live result streams',
+              function=lambda: len(result_broadcaster))
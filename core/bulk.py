@@ -0,0 +1,131 @@
+import csv
+import io
+import json
+from pydantic import ValidationError
+from . import database, crud, validations, jobs
+
+"""This module is responsible for bulk import and export of check definitions as
+NDJSON (one JSON object per line) or CSV (a header line, then one row per line).
+Both directions stream, so neither side holds the whole set in memory"""
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_FIELDS = ('id', 'url', 'frequency', 'expectedStatus', 'expectedString',
+                 'maxLatencyMs', 'timeoutMs')
+MAX_LINE_BYTES = 64 * 1024
+MAX_REPORTED_ERRORS = 1000
+
+async def iter_lines(chunks):
+    """Splits a stream of byte chunks into numbered lines. A line longer than
+    MAX_LINE_BYTES is reported as None and ends the stream, rather than buffering
+    an unbounded amount of input looking for its end."""
+    buffer = b''
+    number = 0
+    async for chunk in chunks:
+        buffer += chunk
+        lines = buffer.split(b'\n')
+        buffer = lines.pop()
+        for line in lines:
+            number += 1
+            yield number, line.rstrip(b'\r')
+        if len(buffer) > MAX_LINE_BYTES:
+            yield number + 1, None
+            return
+    if buffer:
+        yield number + 1, buffer.rstrip(b'\r')
+
+def describe(error: ValidationError) -> str:
+    return '; '.join('{}: {}'.format('.'.join(str(x) for x in e['loc']), e['msg'])
+                     for e in error.errors())
+
+async def read_definitions(chunks, format: str):
+    """Yields (line number, definition, error) for every non-blank line, where
+    exactly one of definition and error is set"""
+    header = None
+    async for number, line in iter_lines(chunks):
+        if line is None:
+            yield number, None, 'line is longer than {} bytes'.format(MAX_LINE_BYTES)
+            return
+        try:
+            text = line.decode('utf-8')
+        except UnicodeDecodeError:
+            yield number, None, 'line is not valid UTF-8'
+            continue
+        if not text.strip():
+            continue
+        try:
+            if format == 'csv':
+                values = next(csv.reader([text]))
+                if header is None:
+                    header = [x.strip() for x in values]
+                    continue
+                if len(values) != len(header):
+                    raise ValueError('expected {} columns, found {}'.format(
+                        len(header), len(values)))
+                # empty cells mean the optional field isn't set
+                record = {k: v for k, v in zip(header, values) if v != ''}
+            else:
+                record = json.loads(text)
+                if not isinstance(record, dict):
+                    raise ValueError('expected a JSON object')
+            yield number, validations.CheckBase(**record), None
+        except ValidationError as e:
+            yield number, None, describe(e)
+        except (ValueError, csv.Error) as e:
+            yield number, None, str(e)
+
+async def _save_batch(session: database.AsyncSession, batch: list,
+                      summary: validations.ImportSummary):
+    stored, created = await crud.upsert_check_definitions(session, batch)
+    summary.created += created
+    summary.updated += len(stored) - created
+    # new checks start as each batch lands, staggered over their frequency
+    jobs.schedule_checks(stored)
+
+async def import_definitions(session: database.AsyncSession, chunks, format: str,
+                             batch_size: int) -> validations.ImportSummary:
+    """Creates or updates definitions (matched by url) from a stream of NDJSON or
+    CSV. Each batch is its own transaction, so a bad line only costs that line."""
+    summary = validations.ImportSummary()
+    batch = []
+    async for number, definition, error in read_definitions(chunks, format):
+        if error is not None:
+            summary.failed += 1
+            if len(summary.errors) < MAX_REPORTED_ERRORS:
+                summary.errors.append(validations.ImportLineError(line=number, error=error))
+            continue
+        batch.append(definition)
+        if len(batch) >= batch_size:
+            await _save_batch(session, batch, summary)
+            batch = []
+    if batch:
+        await _save_batch(session, batch, summary)
+    return summary
+
+def _csv_lines(rows: list) -> str:
+    output = io.StringIO()
+    csv.writer(output, lineterminator='\n').writerows(rows)
+    return output.getvalue()
+
+async def export_definitions(format: str, urlcontains: str = None,
+                             ids: list[int] = None, batch_size: int = 500):
+    """Yields the encoded export a batch of rows at a time"""
+    # the response is still streaming after the handler returns, so this can't
+    # borrow the request's session
+    async with database.OrmSession() as session:
+        if format == 'csv':
+            yield _csv_lines([EXPORT_FIELDS]).encode()
+        batch = []
+        async for row in crud.stream_check_definitions(session, urlcontains, ids,
+                                                       batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield _encode(batch, format)
+                batch = []
+        if batch:
+            yield _encode(batch, format)
+
+def _encode(rows: list, format: str) -> bytes:
+    if format == 'csv':
+        return _csv_lines([[getattr(row, x) for x in EXPORT_FIELDS] for row in rows]).encode()
+    return ''.join(json.dumps({x: getattr(row, x) for x in EXPORT_FIELDS}) + '\n'
+                   for row in rows).encode()
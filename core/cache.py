@@ -0,0 +1,242 @@
+from collections import Counter, OrderedDict
+from typing import List, Optional
+from . import validations
+
+"""This module is responsible for keeping check definitions and their notification
+addresses in memory. It is loaded once at startup and kept current by the write
+functions in crud, so failure handling doesn't need to read the database. It also
+remembers what the last response of each content check looked like, so unchanged
+pages don't have to be downloaded and searched again, and keeps encoded responses
+of the read endpoints until a write changes what they were built from"""
+
+# get environment variables
+settings = validations.EnvironmentSettings()
+
+class DefinitionCache:
+    """Check definitions and receivers keyed by check id. Receivers that aren't
+    cached (a miss) return None, and the caller loads and stores them. Every write
+    is counted, so a merge of what was read from the database can leave alone the
+    checks the API wrote to while that read was in flight."""
+
+    def __init__(self):
+        self._definitions = {}
+        self._receivers = {}
+        # the number of the last write to each check, one int per check the API
+        # has written to, which isn't pruned since reads can overlap each other
+        self._writes = 0
+        self._written = {}
+        # when the last full reconcile pass started reading, None until there's one
+        self.synced_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def _touch(self, checkId: int):
+        self._writes += 1
+        self._written[checkId] = self._writes
+
+    def mark(self) -> int:
+        """To be taken before reading what will be merged"""
+        return self._writes
+
+    def merge(self, definitions: List[validations.Check], mark: int, 
+              removed: list = (), receivers: dict = None):
+        """Stores definitions and receivers (lists keyed by check id) read from the
+        database, and forgets the `removed` checks, except for checks written since
+        `mark`, whose cached state is newer than what was read"""
+        for definition in definitions:
+            if self._written.get(definition.id, 0) <= mark:
+                self._definitions[definition.id] = definition
+        for checkId in removed:
+            if self._written.get(checkId, 0) <= mark:
+                self._definitions.pop(checkId, None)
+                self._receivers.pop(checkId, None)
+        for checkId, emailAddresses in (receivers or {}).items():
+            if checkId in self._definitions and self._written.get(checkId, 0) <= mark:
+                self._receivers[checkId] = list(emailAddresses)
+
+    def check_ids(self) -> set:
+        return set(self._definitions)
+
+    def definitions(self) -> List[validations.Check]:
+        return list(self._definitions.values())
+
+    def get_definition(self, checkId: int) -> Optional[validations.Check]:
+        return self._definitions.get(checkId)
+
+    def put_definition(self, definition: validations.Check):
+        self._touch(definition.id)
+        self._definitions[definition.id] = definition
+        self._receivers.setdefault(definition.id, [])
+
+    def remove_definition(self, checkId: int):
+        self._touch(checkId)
+        self._definitions.pop(checkId, None)
+        self._receivers.pop(checkId, None)
+
+    def get_receivers(self, checkId: int) -> Optional[List[str]]:
+        receivers = self._receivers.get(checkId)
+        if receivers is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return receivers
+
+    def set_receivers(self, checkId: int, receivers: List[str]):
+        self._receivers[checkId] = list(receivers)
+
+    def add_receiver(self, checkId: int, emailAddress: str):
+        self._touch(checkId)
+        # only extend lists we already hold, a partial list would hide the rest
+        receivers = self._receivers.get(checkId)
+        if receivers is not None:
+            receivers.append(emailAddress)
+
+    def invalidate_receivers(self, checkId: int):
+        self._touch(checkId)
+        self._receivers.pop(checkId, None)
+
+class ContentEntry:
+    """What a content check learned from its last response: the validators to send
+    next time, and a digest of the body up to where the verdict was reached"""
+    __slots__ = ('url', 'expectedString', 'statusCode', 'etag', 'lastModified',
+                 'bodyLength', 'bodyDigest', 'passes')
+
+    def __init__(self, url: str, expectedString: str, statusCode: int, etag: str,
+                 lastModified: str, bodyLength: int, bodyDigest: bytes, passes: bool):
+        self.url = url
+        self.expectedString = expectedString
+        self.statusCode = statusCode
+        self.etag = etag
+        self.lastModified = lastModified
+        self.bodyLength = bodyLength
+        self.bodyDigest = bodyDigest
+        self.passes = passes
+
+class ContentCache:
+    """Content check entries keyed by check id, evicting the least recently used
+    past `max_size`. An entry only counts for the url and expected string it was
+    made with, so definitions changed by another worker can't reuse stale ones."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, check_definition: validations.Check) -> Optional[ContentEntry]:
+        entry = self._entries.get(check_definition.id)
+        if entry is None:
+            return None
+        if (entry.url != check_definition.url
+                or entry.expectedString != check_definition.expectedString):
+            del self._entries[check_definition.id]
+            return None
+        self._entries.move_to_end(check_definition.id)
+        return entry
+
+    def put(self, checkId: int, entry: ContentEntry):
+        if not self.max_size:
+            return
+        self._entries[checkId] = entry
+        self._entries.move_to_end(checkId)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, checkId: int):
+        self._entries.pop(checkId, None)
+
+class CachedResponse:
+    """An encoded API response, with the topic versions it was built against"""
+    __slots__ = ('statusCode', 'body', 'headers', 'etag', 'topics', 'versions', 'expires')
+
+    def __init__(self, statusCode: int, body: bytes, headers: dict, etag: str,
+                 topics: tuple, versions: tuple, expires: float):
+        self.statusCode = statusCode
+        self.body = body
+        self.headers = headers
+        self.etag = etag
+        self.topics = topics
+        self.versions = versions
+        self.expires = expires
+
+class ResponseCache:
+    """Encoded responses keyed by path and query parameters, evicting the least
+    recently used past `max_bytes` of bodies. Every entry names the topics it was
+    built from ('definitions', 'addresses' or 'results'), and a write bumps the
+    version of the topics it touches, which leaves every entry built from them
+    stale without having to find them. New results only bump their own check's
+    topic, ('results', checkId), since they arrive every flush. Other workers'
+    writes aren't seen, so entries also expire after `ttl` seconds."""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._versions = Counter()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def size(self) -> int:
+        return self._bytes
+
+    def versions(self, topics: tuple) -> tuple:
+        return tuple(self._versions[topic] for topic in topics)
+
+    def get(self, key: tuple, now: float) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires > now and entry.versions == self.versions(entry.topics):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, statusCode: int, body: bytes, headers: dict, etag: str,
+            topics: tuple, versions: tuple, now: float) -> CachedResponse:
+        """`versions` must be taken before the response was built, so that a write
+        made while it was being built leaves it stale"""
+        entry = CachedResponse(statusCode, body, headers, etag, topics, versions,
+                               now + self.ttl)
+        if not self.ttl or len(body) > self.max_bytes:
+            return entry
+        self._remove(key)
+        self._entries[key] = entry
+        self._bytes += len(body)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.body)
+        return entry
+
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry.body)
+
+    def invalidate(self, *topics: str):
+        for topic in topics:
+            self._versions[topic] += 1
+
+def to_check(db_check_definition) -> validations.Check:
+    # rows come from the database, where they were stored after validation, so
+    # they're not validated again. Addresses are tracked separately, so they're
+    # left off the cached definition
+    return validations.Check.construct(id=db_check_definition.id, url=db_check_definition.url,
+                                       frequency=db_check_definition.frequency,
+                                       expectedStatus=db_check_definition.expectedStatus,
+                                       expectedString=db_check_definition.expectedString,
+                                       maxLatencyMs=db_check_definition.maxLatencyMs,
+                                       timeoutMs=db_check_definition.timeoutMs)
+
+definition_cache = DefinitionCache()
+content_cache = ContentCache(max_size=settings.content_cache_size)
+response_cache = ResponseCache(max_bytes=settings.response_cache_bytes,
+                               ttl=settings.response_cache_ttl)
@@ -0,0 +1,69 @@
+import asyncio
+from datetime import datetime, timedelta
+from . import database, crud, validations, jobs
+
+"""This module is responsible for saving where every check is in its schedule, its
+next due time and consecutive failure count, so a restart picks the schedule up
+where it left off. Only checks that moved since the last save are written, all
+in one statement, every `schedule_checkpoint_interval` seconds"""
+
+# get environment variables
+settings = validations.EnvironmentSettings()
+
+class ScheduleCheckpointer:
+    """Periodically saves the changed entries of `scheduler`, and once more when
+    stopped so a clean shutdown loses nothing"""
+
+    def __init__(self, scheduler, interval: float):
+        self.scheduler = scheduler
+        self.interval = interval
+        self._task = None
+
+    async def save(self) -> int:
+        entries = self.scheduler.take_dirty()
+        if not entries:
+            return 0
+        # due times are event loop times, which mean nothing to the next process
+        loop = asyncio.get_running_loop()
+        now, loop_now = datetime.now(), loop.time()
+        schedules = [{'checkId': x.definition.id,
+                      'nextDue': now + timedelta(seconds=x.due - loop_now),
+                      'failCount': x.fail_count} for x in entries]
+        try:
+            async with database.OrmSession() as session:
+                await crud.save_schedules(session, schedules)
+        except Exception:
+            # try these again next time, unless they were removed meanwhile
+            for entry in entries:
+                self.scheduler.mark_dirty(entry.definition.id)
+            raise
+        return len(schedules)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save()
+            except Exception as e:
+                print('Error saving the check schedule: {}'.format(e))
+
+    def start(self):
+        if self.interval:
+            self._task = asyncio.create_task(self._run(), name='schedule-checkpointer')
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        try:
+            await self.save()
+        except Exception as e:
+            print('Error saving the check schedule: {}'.format(e))
+
+schedule_checkpointer = ScheduleCheckpointer(jobs.check_scheduler,
+                                             interval=settings.schedule_checkpoint_interval)
@@ -0,0 +1,180 @@
+import asyncio
+import collections
+import httpx
+from . import validations
+
+"""This module is responsible for the outbound HTTP client shared by every URL check.
+Sharing one connection pool lets checks against the same host reuse open
+connections and TLS sessions instead of handshaking on every request. It also
+keeps checks polite towards each host they target, and stops sending requests
+to hosts that are down until a probe finds them up again"""
+
+# get environment variables
+settings = validations.EnvironmentSettings()
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive requests to a host fail to get
+    any response. While open, requests are refused, except for one probe every
+    `reset_timeout` seconds, and the first probe that gets a response closes it."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    def refuses(self, now: float) -> bool:
+        """Whether allow would refuse a request now"""
+        return self.opened_at is not None and (
+            self.probing or now - self.opened_at < self.reset_timeout)
+
+    def allow(self, now: float) -> bool:
+        """Whether a request may go out. When it's a probe, the caller must report
+        how it went with record_success or record_failure."""
+        if self.opened_at is None:
+            return True
+        if self.refuses(now):
+            return False
+        self.probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self, now: float):
+        self.failures += 1
+        if self.probing or (self.failure_threshold 
+                            and self.failures >= self.failure_threshold):
+            # a failed probe restarts the wait for the next one
+            self.opened_at = now
+        self.probing = False
+
+class Host:
+    """Politeness limits for one host: at most `max_connections` requests at once,
+    and request starts at least `min_interval` seconds apart. Slots are handed out
+    without waiting, so checks held back by a busy host don't tie up a worker."""
+
+    def __init__(self, max_connections: int, min_interval: float, 
+                 breaker: CircuitBreaker):
+        self.max_connections = max_connections
+        self.min_interval = min_interval
+        self.breaker = breaker
+        self._active = 0
+        self._next_start = 0.0
+        self._waiting = collections.deque()
+
+    def admit(self, waiter, resume):
+        """Takes a slot for `waiter` and returns the function that gives it back
+        if its request may start now. Otherwise returns None, and once a slot is
+        taken for it and its start time comes, `resume(waiter, release)` is called
+        instead. Waiters are served in the order they came."""
+        if self.breaker.refuses(asyncio.get_running_loop().time()):
+            # the request won't be sent, so it needn't wait its turn
+            return lambda: None
+        if self._active >= self.max_connections or self._waiting:
+            self._waiting.append((waiter, resume))
+            return None
+        return self._take(waiter, resume)
+
+    def _take(self, waiter, resume):
+        self._active += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._release()
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # the start time is reserved now, so waiters are spaced out behind each
+        # other instead of all starting when the interval is up
+        start = max(now, self._next_start)
+        self._next_start = start + self.min_interval
+        if start > now:
+            loop.call_at(start, resume, waiter, release)
+            return None
+        return release
+
+    def _release(self):
+        self._active -= 1
+        while self._waiting and self._active < self.max_connections:
+            waiter, resume = self._waiting.popleft()
+            release = self._take(waiter, resume)
+            if release is not None:
+                resume(waiter, release)
+
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+class ClientManager:
+    """Owns the process-wide httpx client and the politeness limits and circuit
+    breaker of every host checks have targeted."""
+
+    def __init__(self, max_connections: int, max_keepalive_connections: int,
+                 keepalive_expiry: float, per_host_connections: int, http2: bool,
+                 per_host_interval: float, breaker_threshold: int, 
+                 breaker_reset_timeout: float):
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        self.per_host_connections = per_host_connections
+        self.per_host_interval = per_host_interval
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self.http2 = http2
+        self._client = None
+        self._hosts = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = self._create_client()
+        return self._client
+
+    def _create_client(self) -> httpx.AsyncClient:
+        if self.http2:
+            try:
+                return httpx.AsyncClient(limits=self.limits, http2=True)
+            except ImportError:
+                # h2 is in requirements.txt, but installs without it fall back
+                print('HTTP/2 requested but the h2 package is not installed, using HTTP/1.1')
+        return httpx.AsyncClient(limits=self.limits)
+
+    def host(self, url: str) -> Host:
+        """Returns the limits and circuit breaker for the host of `url`"""
+        name = httpx.URL(url).host
+        host = self._hosts.get(name)
+        if host is None:
+            breaker = CircuitBreaker(self.breaker_threshold, self.breaker_reset_timeout)
+            host = self._hosts[name] = Host(self.per_host_connections, 
+                                            self.per_host_interval, breaker)
+        return host
+
+    def open_circuits(self) -> int:
+        return sum(1 for x in self._hosts.values() if x.breaker.open)
+
+    def waiting(self) -> int:
+        return sum(x.waiting() for x in self._hosts.values())
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+client_manager = ClientManager(max_connections=settings.http_max_connections,
+                               max_keepalive_connections=settings.http_max_keepalive_connections,
+                               keepalive_expiry=settings.http_keepalive_expiry,
+                               per_host_connections=settings.http_per_host_connections,
+                               http2=settings.http_use_http2,
+                               per_host_interval=settings.http_per_host_interval,
+                               breaker_threshold=settings.circuit_breaker_threshold,
+                               breaker_reset_timeout=settings.circuit_breaker_reset_timeout)
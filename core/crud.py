@@ -1,34 +1,183 @@
-from sqlalchemy import select, delete, update 
-from sqlalchemy.sql.functions import max
+from datetime import datetime
+from sqlalchemy import (select, delete, update, insert, func, and_, or_, case, literal, 
+                        bindparam, Integer)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import aliased, noload
 from . database import AsyncSession
-from . import models, validations
+from . import models, validations, cache, search
 
 """This module is responsible for general DAL (Data Access Layer) functions."""
 
-async def get_check_defintions(session: AsyncSession, 
-                               urlcontains: str = None) -> list[validations.Check]:
-    query = select(models.CheckDefinition)
-    if urlcontains:
-        query = query.filter(models.CheckDefinition.url.contains(urlcontains))
+def _upsert(session: AsyncSession, table):
+    # upserts aren't part of standard SQL, so pick the dialect's own insert construct
+    if session.bind.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+class UnknownCursor(LookupError):
+    """Raised for a keyset pagination cursor that names a row that doesn't exist,
+    or no longer matches the filters"""
+
+async def _paginate(session: AsyncSession, query, sort_columns: dict, 
+                    page: validations.PageParams):
+    """Applies sorting and either offset or keyset pagination to a query. The id
+    column is always used as a tie breaker so the row order is stable."""
+    id_column = sort_columns['id']
+    sort_column = sort_columns.get(page.sort, id_column)
+    if page.after is not None:
+        # keyset pagination continues from the sort value of the last row seen,
+        # which unlike an offset doesn't get slower the deeper the page. The sort
+        # column is added rather than swapped in so the query keeps its joins.
+        last = await session.execute(query.add_columns(sort_column.label('cursor')).where(
+            id_column == page.after).limit(1))
+        last = last.first()
+        if last is None:
+            raise UnknownCursor(page.after)
+        query = query.where(_after_cursor(sort_column, id_column, last.cursor, 
+                                          page.after, page.descending))
+    else:
+        query = query.offset(page.offset)
+    if page.descending:
+        order = [sort_column.desc(), id_column.desc()]
+    else:
+        order = [sort_column.asc(), id_column.asc()]
+    if sort_column.nullable:
+        # SQLite's own order, spelled out so other databases page the same way
+        order[0] = order[0].nullslast() if page.descending else order[0].nullsfirst()
+    return query.order_by(*order).limit(page.limit)
+
+def _after_cursor(sort_column, id_column, last_value, last_id: int, descending: bool):
+    """The rows that come after the cursor row in the page order. NULLs sort
+    before every value going up and after every value going down, and can't be
+    compared, so they're matched with IS NULL."""
+    if last_value is None:
+        if descending:
+            return and_(sort_column.is_(None), id_column < last_id)
+        return or_(and_(sort_column.is_(None), id_column > last_id), 
+                   sort_column.isnot(None))
+    if descending:
+        after = or_(sort_column < last_value, and_(
+            sort_column == last_value, id_column < last_id))
+        return or_(after, sort_column.is_(None)) if sort_column.nullable else after
+    return or_(sort_column > last_value, and_(
+        sort_column == last_value, id_column > last_id))
+
+async def _count(session: AsyncSession, query):
+    result = await session.execute(select(func.count()).select_from(query.subquery()))
+    return result.scalar()
+
+def _check_definition_filters(urlcontains: str = None, ids: list[int] = None, 
+                              hostcontains: str = None, pathcontains: str = None):
+    filters = search.url_index.filters(url=urlcontains, host=hostcontains, 
+                                       path=pathcontains)
+    if ids:
+        filters.append(models.CheckDefinition.id.in_(ids))
+    return filters
+
+async def get_check_defintions(session: AsyncSession, urlcontains: str = None, 
+                               ids: list[int] = None, 
+                               page: validations.PageParams = None, 
+                               hostcontains: str = None, pathcontains: str = None):
+    """Definition rows without their addresses, get_addresses_for_checks has those.
+    Plain column rows are much cheaper to load than ORM objects."""
+    query = select(*models.CheckDefinition.__table__.c).where(
+        *_check_definition_filters(urlcontains, ids, hostcontains, pathcontains))
+    if page:
+        query = await _paginate(session, query, models.CheckDefinition.__table__.c, page)
     result = await session.execute(query)
-    return result.scalars().all()
+    return result.all()
+
+async def count_check_definitions(session: AsyncSession, urlcontains: str = None, 
+                                  ids: list[int] = None, hostcontains: str = None, 
+                                  pathcontains: str = None):
+    return await _count(session, select(models.CheckDefinition.id).where(
+        *_check_definition_filters(urlcontains, ids, hostcontains, pathcontains)))
 
 async def create_check_defintion(session: AsyncSession, 
                                  check_definition: validations.CheckBase):
     db_check_definition = models.CheckDefinition(**check_definition.dict())
     session.add(db_check_definition)
     await session.commit()
+    cache.definition_cache.put_definition(cache.to_check(db_check_definition))
+    cache.response_cache.invalidate('definitions')
     return db_check_definition
 
+async def upsert_check_definitions(session: AsyncSession, 
+                                   check_definitions: list[validations.CheckBase]):
+    """Creates or updates (matched by url) many definitions in one transaction.
+    Returns the stored definitions and how many of them are new."""
+    # a url listed twice keeps its last values, just like two single updates would
+    rows = {x.url: x.dict() for x in check_definitions}
+    urls = list(rows)
+    existing = await session.execute(select(models.CheckDefinition.url).where(
+        models.CheckDefinition.url.in_(urls)))
+    existing_count = len(existing.scalars().all())
+    query = _upsert(session, models.CheckDefinition)
+    query = query.on_conflict_do_update(
+        index_elements=[models.CheckDefinition.url],
+        set_={name: query.excluded[name] for name in ('frequency', 'expectedStatus', 
+                                                      'expectedString', 'maxLatencyMs', 
+                                                      'timeoutMs', 'updatedAt')})
+    await session.execute(query, list(rows.values()))
+    result = await session.execute(select(models.CheckDefinition).options(
+        noload(models.CheckDefinition.emailAddresses)).where(
+            models.CheckDefinition.url.in_(urls)))
+    stored = [cache.to_check(x) for x in result.scalars().all()]
+    await session.commit()
+    for check_definition in stored:
+        cache.definition_cache.put_definition(check_definition)
+        cache.content_cache.invalidate(check_definition.id)
+    cache.response_cache.invalidate('definitions')
+    return stored, len(rows) - existing_count
+
+async def get_check_ids(session: AsyncSession) -> set:
+    # run on the connection, since the ORM's handling of each row costs more
+    # than reading it and this reads every definition
+    connection = await session.connection()
+    result = await connection.execute(select(models.CheckDefinition.id))
+    return set(result.scalars().all())
+
+async def get_changed_check_definitions(session: AsyncSession, since: datetime, 
+                                        ids: list[int] = ()):
+    """Definition rows written since `since`, and those in `ids`"""
+    query = select(*models.CheckDefinition.__table__.c).where(or_(
+        models.CheckDefinition.updatedAt >= since, models.CheckDefinition.id.in_(ids)))
+    result = await session.execute(query)
+    return result.all()
+
+async def get_receiver_pairs(session: AsyncSession, checkIds: list[int] = None):
+    """(check id, address) rows of the notification addresses of the given checks,
+    or of every check, read on the connection like get_check_ids"""
+    query = select(models.NotificationAddress.checkId, 
+                   models.NotificationAddress.emailAddress)
+    if checkIds is not None:
+        query = query.where(models.NotificationAddress.checkId.in_(checkIds))
+    connection = await session.connection()
+    result = await connection.execute(query)
+    return result.all()
+
+async def stream_check_definitions(session: AsyncSession, urlcontains: str = None, 
+                                   ids: list[int] = None, batch_size: int = 500):
+    """Yields definition rows without loading the whole table into memory"""
+    query = select(*models.CheckDefinition.__table__.c).where(
+        *_check_definition_filters(urlcontains, ids)).order_by(models.CheckDefinition.id)
+    result = await session.stream(query.execution_options(yield_per=batch_size))
+    async for row in result:
+        yield row
+
 async def get_check_definition_by_id(session: AsyncSession, checkId: int):
-    result = await session.execute(select(models.CheckDefinition).filter(
+    result = await session.execute(select(*models.CheckDefinition.__table__.c).filter(
         models.CheckDefinition.id == checkId))
-    return result.scalars().first()
+    return result.first()
 
 async def delete_check_definition_by_id(session: AsyncSession, checkId: int):
     result = await session.execute(delete(models.CheckDefinition).filter(
         models.CheckDefinition.id == checkId))
     await session.commit()
+    cache.definition_cache.remove_definition(checkId)
+    cache.content_cache.invalidate(checkId)
+    # the check's addresses and results go with it
+    cache.response_cache.invalidate('definitions', 'addresses', 'results')
     return result.rowcount
 
 async def update_check_definition_by_id(session: AsyncSession, checkId: int, 
@@ -36,11 +185,45 @@ async def update_check_definition_by_id(session: AsyncSession, checkId: int,
     result = await session.execute(update(models.CheckDefinition).values(
         **check_definition.dict()).where(models.CheckDefinition.id == checkId))
     await session.commit()
+    if result.rowcount == 1:
+        cache.definition_cache.put_definition(
+            validations.Check(id=checkId, **check_definition.dict()))
+        cache.content_cache.invalidate(checkId)
+        cache.response_cache.invalidate('definitions')
     return result.rowcount
 
-async def get_check_results(session: AsyncSession):
-    result = await session.execute(select(models.CheckResult))
-    return result.scalars().all()
+def _check_result_filters(checkId: int = None, state: str = None, 
+                          since: datetime = None, until: datetime = None, 
+                          ids: list[int] = None):
+    filters = []
+    if checkId:
+        filters.append(models.CheckResult.checkId == checkId)
+    if state:
+        filters.append(models.CheckResult.state == state)
+    if since:
+        filters.append(models.CheckResult.timeChecked >= since)
+    if until:
+        filters.append(models.CheckResult.timeChecked < until)
+    if ids:
+        filters.append(models.CheckResult.id.in_(ids))
+    return filters
+
+async def get_check_results(session: AsyncSession, checkId: int = None, 
+                            state: str = None, since: datetime = None, 
+                            until: datetime = None, ids: list[int] = None, 
+                            page: validations.PageParams = None):
+    query = select(*models.CheckResult.__table__.c).where(
+        *_check_result_filters(checkId, state, since, until, ids))
+    if page:
+        query = await _paginate(session, query, models.CheckResult.__table__.c, page)
+    result = await session.execute(query)
+    return result.all()
+
+async def count_check_results(session: AsyncSession, checkId: int = None, 
+                              state: str = None, since: datetime = None, 
+                              until: datetime = None, ids: list[int] = None):
+    return await _count(session, select(models.CheckResult.id).where(
+        *_check_result_filters(checkId, state, since, until, ids)))
 
 async def save_check_result(session: AsyncSession, 
                             check_result: validations.CheckResultBase):
@@ -49,58 +232,377 @@ async def save_check_result(session: AsyncSession,
     await session.commit()
     return db_check_result
 
-async def get_notification_addresses(session: AsyncSession, checkId: int = None):
-    query = select(models.NotificationAddress)
+async def get_schedule_page(session: AsyncSession, after_id: int, limit: int):
+    """A page of definitions in id order, each with its saved schedule state (or
+    None for checks that were never saved)"""
+    result = await session.execute(
+        select(models.CheckDefinition, models.CheckSchedule)
+        .outerjoin(models.CheckSchedule, 
+                   models.CheckSchedule.checkId == models.CheckDefinition.id)
+        .options(noload(models.CheckDefinition.emailAddresses))
+        .where(models.CheckDefinition.id > after_id)
+        .order_by(models.CheckDefinition.id).limit(limit))
+    return result.all()
+
+async def get_schedules(session: AsyncSession, checkIds: list[int]):
+    """Saved schedule state rows of the given checks, which have none if never saved"""
+    result = await session.execute(select(*models.CheckSchedule.__table__.c).where(
+        models.CheckSchedule.checkId.in_(checkIds)))
+    return result.all()
+
+async def save_schedules(session: AsyncSession, schedules: list[dict]):
+    """Upserts (checkId, nextDue, failCount) rows in one statement"""
+    query = _upsert(session, models.CheckSchedule)
+    query = query.on_conflict_do_update(
+        index_elements=[models.CheckSchedule.checkId],
+        set_={'nextDue': query.excluded.nextDue, 
+              'failCount': query.excluded.failCount})
+    await session.execute(query, schedules)
+    await session.commit()
+
+async def get_existing_check_ids(session: AsyncSession, checkIds: list[int]) -> set:
+    result = await session.execute(select(models.CheckDefinition.id).where(
+        models.CheckDefinition.id.in_(checkIds)))
+    return set(result.scalars().all())
+
+async def save_check_results(session: AsyncSession, 
+                             check_results: list[validations.CheckResultBase]):
+    # a single executemany insert is far cheaper than adding ORM objects one by one
+    await session.execute(insert(models.CheckResult), 
+                          [check_result.dict() for check_result in check_results])
+    await save_latest_results(session, check_results)
+    await session.commit()
+    # responses that aren't about particular checks would go stale every flush, so
+    # they're left to their ttl
+    cache.response_cache.invalidate(*{('results', x.checkId) for x in check_results})
+    return len(check_results)
+
+def _notification_address_filters(checkId: int = None, ids: list[int] = None):
+    filters = []
     if checkId:
-        query = query.filter(models.NotificationAddress.checkId == checkId)
+        filters.append(models.NotificationAddress.checkId == checkId)
+    if ids:
+        filters.append(models.NotificationAddress.id.in_(ids))
+    return filters
+
+async def get_notification_addresses(session: AsyncSession, checkId: int = None, 
+                                     ids: list[int] = None, 
+                                     page: validations.PageParams = None):
+    query = select(*models.NotificationAddress.__table__.c).where(
+        *_notification_address_filters(checkId, ids))
+    if page:
+        query = await _paginate(session, query, 
+                                models.NotificationAddress.__table__.c, page)
     result = await session.execute(query)
-    return result.scalars().all()
+    return result.all()
+
+async def count_notification_addresses(session: AsyncSession, checkId: int = None, 
+                                       ids: list[int] = None):
+    return await _count(session, select(models.NotificationAddress.id).where(
+        *_notification_address_filters(checkId, ids)))
+
+async def _touch_check_definitions(session: AsyncSession, checkIds: list[int]):
+    # reconciling reads addresses along with the definitions written since its
+    # last pass, so address writes mark their checks as written too
+    await session.execute(update(models.CheckDefinition).values(
+        updatedAt=datetime.now()).where(models.CheckDefinition.id.in_(checkIds)))
 
 async def create_notification_address(session: AsyncSession, 
                                       address_definition: 
                                       validations.NotificationAddressBase):
     db_address_definition = models.NotificationAddress(**address_definition.dict())
     session.add(db_address_definition)
+    await _touch_check_definitions(session, [address_definition.checkId])
     await session.commit()
+    cache.definition_cache.add_receiver(address_definition.checkId, 
+                                        address_definition.emailAddress)
+    cache.response_cache.invalidate('addresses')
     return db_address_definition
 
 async def get_notification_address_by_id(session: AsyncSession, 
                                          notificationId: int):
-    result = await session.execute(select(models.NotificationAddress).filter(
+    result = await session.execute(select(*models.NotificationAddress.__table__.c).filter(
+        models.NotificationAddress.id == notificationId))
+    return result.first()
+
+async def _get_notification_check_id(session: AsyncSession, notificationId: int):
+    result = await session.execute(select(models.NotificationAddress.checkId).filter(
         models.NotificationAddress.id == notificationId))
-    return result.scalars().first()
+    return result.scalar()
 
 async def delete_notification_address_by_id(session: AsyncSession, notificationId: int):
+    previous_check_id = await _get_notification_check_id(session, notificationId)
     result = await session.execute(delete(models.NotificationAddress).filter(
         models.NotificationAddress.id == notificationId))
+    if previous_check_id:
+        await _touch_check_definitions(session, [previous_check_id])
     await session.commit()
+    if previous_check_id:
+        cache.definition_cache.invalidate_receivers(previous_check_id)
+    cache.response_cache.invalidate('addresses')
     return result.rowcount
 
 async def update_notification_address_by_id(session: AsyncSession, addressId: int, 
                                             address_definition: 
                                             validations.NotificationAddressBase):
+    previous_check_id = await _get_notification_check_id(session, addressId)
     result = await session.execute(update(models.NotificationAddress).values(
         **address_definition.dict()).where(models.NotificationAddress.id == addressId))
+    await _touch_check_definitions(session, [previous_check_id, address_definition.checkId])
     await session.commit()
+    # the address may have moved between checks, so drop both lists
+    if previous_check_id:
+        cache.definition_cache.invalidate_receivers(previous_check_id)
+    cache.definition_cache.invalidate_receivers(address_definition.checkId)
+    cache.response_cache.invalidate('addresses')
     return result.rowcount
 
+async def get_addresses_for_checks(session: AsyncSession, checkIds: list[int]):
+    """Address rows of all of the given checks in one query, for nesting them"""
+    if not checkIds:
+        return []
+    result = await session.execute(select(*models.NotificationAddress.__table__.c).where(
+        models.NotificationAddress.checkId.in_(checkIds)).order_by(
+            models.NotificationAddress.id))
+    return result.all()
+
 async def get_notification_addresses_by_check_id(session: AsyncSession, checkId: int):
     result = await session.execute(select(models.NotificationAddress).filter(
         models.NotificationAddress.checkId == checkId))
     return result.scalars().all()
 
-async def get_latest_results(session: AsyncSession, 
-                             urlcontains: str = None) -> list[validations.LatestResult]:
-    lastResults = select(models.CheckResult.id, models.CheckResult.checkId, 
-                    models.CheckResult.state.label('lastState'), 
-                    max(models.CheckResult.timeChecked).label('lastChecked')).group_by(
-                        models.CheckResult.checkId).subquery('lastResults')
+async def save_latest_results(session: AsyncSession, 
+                              check_results: list[validations.CheckResultBase]):
+    latest = {}
+    for check_result in check_results:
+        current = latest.get(check_result.checkId)
+        if current is None or check_result.timeChecked >= current.timeChecked:
+            latest[check_result.checkId] = check_result
+    if not latest:
+        return
+    query = _upsert(session, models.LatestResult)
+    query = query.on_conflict_do_update(
+        index_elements=[models.LatestResult.checkId],
+        set_={'timeChecked': query.excluded.timeChecked,
+              'statusCode': query.excluded.statusCode,
+              'state': query.excluded.state,
+              'latencyMs': query.excluded.latencyMs},
+        # never let a late batch overwrite a newer result
+        where=models.LatestResult.timeChecked <= query.excluded.timeChecked)
+    await session.execute(query, [check_result.dict(include={'checkId', 'timeChecked', 
+                                                             'statusCode', 'state', 
+                                                             'latencyMs'})
+                                  for check_result in latest.values()])
+
+async def rebuild_latest_results(session: AsyncSession):
+    """Populates the latest_results table from the full results history. Only
+    needed once for databases that predate the latest_results table."""
+    newer = aliased(models.CheckResult)
+    latest_id = select(newer.id).where(
+        newer.checkId == models.CheckResult.checkId).order_by(
+            newer.timeChecked.desc(), newer.id.desc()).limit(1).scalar_subquery()
+    query = select(models.CheckResult.checkId, models.CheckResult.timeChecked, 
+                   models.CheckResult.statusCode, models.CheckResult.state, 
+                   models.CheckResult.latencyMs).where(
+                       models.CheckResult.id == latest_id)
+    await session.execute(delete(models.LatestResult))
+    await session.execute(insert(models.LatestResult).from_select(
+        ['checkId', 'timeChecked', 'statusCode', 'state', 'latencyMs'], query))
+    await session.commit()
+
+async def has_latest_results(session: AsyncSession):
+    result = await session.execute(select(models.LatestResult.checkId).limit(1))
+    return result.first() is not None
+
+def _latest_result_filters(urlcontains: str = None, state: str = None, 
+                           ids: list[int] = None, hostcontains: str = None, 
+                           pathcontains: str = None):
+    filters = _check_definition_filters(urlcontains, ids, hostcontains, pathcontains)
+    if state:
+        filters.append(models.LatestResult.state == state)
+    return filters
+
+async def get_latest_results(session: AsyncSession, urlcontains: str = None, 
+                             state: str = None, ids: list[int] = None, 
+                             page: validations.PageParams = None, 
+                             hostcontains: str = None, pathcontains: str = None
+                             ) -> list[validations.LatestResult]:
     query = select(models.CheckDefinition.id, models.CheckDefinition.url, 
                    models.CheckDefinition.frequency, 
                    models.CheckDefinition.expectedStatus, 
                    models.CheckDefinition.expectedString,
-                   lastResults.c.lastState, lastResults.c.lastChecked).join(lastResults)
-    if urlcontains:
-        query = query.filter(models.CheckDefinition.url.contains(urlcontains))
+                   models.CheckDefinition.maxLatencyMs, 
+                   models.CheckDefinition.timeoutMs,
+                   models.LatestResult.state.label('lastState'), 
+                   models.LatestResult.timeChecked.label('lastChecked'),
+                   models.LatestResult.latencyMs.label('lastLatencyMs')).join(
+                       models.LatestResult).where(
+                           *_latest_result_filters(urlcontains, state, ids, 
+                                                   hostcontains, pathcontains))
+    if page:
+        sort_columns = dict(models.CheckDefinition.__table__.c.items(), 
+                            lastState=models.LatestResult.state, 
+                            lastChecked=models.LatestResult.timeChecked)
+        query = await _paginate(session, query, sort_columns, page)
     result = await session.execute(query)
     return result.all()
+
+async def count_latest_results(session: AsyncSession, urlcontains: str = None, 
+                               state: str = None, ids: list[int] = None, 
+                               hostcontains: str = None, pathcontains: str = None):
+    return await _count(session, select(models.CheckDefinition.id).join(
+        models.LatestResult).where(*_latest_result_filters(urlcontains, state, ids, 
+                                                           hostcontains, pathcontains)))
+
+async def get_results_after(session: AsyncSession, after_id: int = 0, 
+                            limit: int = 1000):
+    result = await session.execute(select(models.CheckResult.id, 
+                                          models.CheckResult.checkId, 
+                                          models.CheckResult.timeChecked, 
+                                          models.CheckResult.statusCode, 
+                                          models.CheckResult.state, 
+                                          models.CheckResult.latencyMs).where(
+        models.CheckResult.id > after_id).order_by(models.CheckResult.id).limit(limit))
+    return result.all()
+
+async def get_rollup_watermark(session: AsyncSession, name: str = 'results'):
+    result = await session.execute(select(models.RollupWatermark.lastResultId).where(
+        models.RollupWatermark.name == name))
+    return result.scalar() or 0
+
+async def set_rollup_watermark(session: AsyncSession, lastResultId: int, 
+                               name: str = 'results'):
+    query = _upsert(session, models.RollupWatermark).values(name=name, 
+                                                             lastResultId=lastResultId)
+    query = query.on_conflict_do_update(index_elements=[models.RollupWatermark.name],
+                                        set_={'lastResultId': query.excluded.lastResultId})
+    await session.execute(query)
+
+async def delete_expired_results(session: AsyncSession, cutoff: datetime, 
+                                 through_id: int, limit: int = 1000):
+    expired = select(models.CheckResult.id).where(
+        models.CheckResult.timeChecked < cutoff, 
+        models.CheckResult.id <= through_id).order_by(models.CheckResult.id).limit(limit)
+    result = await session.execute(delete(models.CheckResult).where(
+        models.CheckResult.id.in_(expired)).execution_options(
+            synchronize_session=False))
+    return result.rowcount
+
+async def get_rollups(session: AsyncSession, period: str, 
+                      start: datetime, end: datetime):
+    result = await session.execute(select(models.CheckResultRollup).where(
+        models.CheckResultRollup.period == period,
+        models.CheckResultRollup.bucketStart >= start, 
+        models.CheckResultRollup.bucketStart <= end))
+    return result.scalars().all()
+
+async def save_rollups(session: AsyncSession, new: list[dict], changed: list[dict]):
+    """Inserts `new` rollups and updates `changed` ones, which carry their row id
+    as 'rollupId', each as a single executemany statement"""
+    table = models.CheckResultRollup.__table__
+    if new:
+        await session.execute(insert(table), new)
+    if changed:
+        await session.execute(update(table).where(table.c.id == bindparam('rollupId')), 
+                              changed)
+
+async def delete_expired_rollups(session: AsyncSession, period: str, 
+                                 cutoff: datetime, limit: int = 1000):
+    expired = select(models.CheckResultRollup.id).where(
+        models.CheckResultRollup.period == period, 
+        models.CheckResultRollup.bucketStart < cutoff).limit(limit)
+    result = await session.execute(delete(models.CheckResultRollup).where(
+        models.CheckResultRollup.id.in_(expired)).execution_options(
+            synchronize_session=False))
+    await session.commit()
+    return result.rowcount
+
+def _bucket(session: AsyncSession, column, since_epoch: int, bucket_seconds: int = None):
+    """SQL expression numbering `bucket_seconds` wide buckets from `since_epoch`.
+    Timestamps are stored without a timezone, so both sides are read as UTC."""
+    if not bucket_seconds:
+        return literal(0)
+    if session.bind.dialect.name == 'postgresql':
+        epoch = func.extract('epoch', column).cast(Integer)
+    else:
+        epoch = func.strftime('%s', column).cast(Integer)
+    return (epoch - since_epoch) / bucket_seconds
+
+async def get_result_aggregates(session: AsyncSession, checkIds: list[int], 
+                                since: datetime, until: datetime, after_id: int,
+                                since_epoch: int, bucket_seconds: int = None):
+    """Counts, failures and latency totals per check, bucket and status code of
+    the raw results that aren't rolled up yet"""
+    bucket = _bucket(session, models.CheckResult.timeChecked, since_epoch, 
+                     bucket_seconds).label('bucket')
+    result = await session.execute(select(
+        models.CheckResult.checkId, bucket, models.CheckResult.statusCode,
+        func.count().label('count'),
+        func.sum(case((models.CheckResult.state == 'SUCCESS', 0), else_=1)).label('failures'),
+        func.count(models.CheckResult.latencyMs).label('latencyCount'),
+        func.sum(models.CheckResult.latencyMs).label('latencySum'),
+        func.min(models.CheckResult.latencyMs).label('latencyMin'),
+        func.max(models.CheckResult.latencyMs).label('latencyMax')).where(
+            *_check_result_filters(since=since, until=until),
+            models.CheckResult.checkId.in_(checkIds),
+            models.CheckResult.id > after_id).group_by(
+                models.CheckResult.checkId, bucket, models.CheckResult.statusCode))
+    return result.all()
+
+async def get_latency_counts(session: AsyncSession, checkIds: list[int], 
+                             since: datetime, until: datetime, after_id: int,
+                             since_epoch: int, bucket_seconds: int = None):
+    """How often each latency occurs per check and bucket among the raw results
+    that aren't rolled up yet"""
+    bucket = _bucket(session, models.CheckResult.timeChecked, since_epoch, 
+                     bucket_seconds).label('bucket')
+    result = await session.execute(select(
+        models.CheckResult.checkId, bucket, models.CheckResult.latencyMs,
+        func.count().label('count')).where(
+            *_check_result_filters(since=since, until=until),
+            models.CheckResult.checkId.in_(checkIds),
+            models.CheckResult.id > after_id,
+            models.CheckResult.latencyMs.isnot(None)).group_by(
+                models.CheckResult.checkId, bucket, models.CheckResult.latencyMs))
+    return result.all()
+
+async def get_rollup_aggregates(session: AsyncSession, checkIds: list[int], 
+                                period: str, since: datetime, until: datetime, 
+                                since_epoch: int, bucket_seconds: int = None):
+    bucket = _bucket(session, models.CheckResultRollup.bucketStart, since_epoch, 
+                     bucket_seconds).label('bucket')
+    result = await session.execute(select(
+        models.CheckResultRollup.checkId, bucket, models.CheckResultRollup.count, 
+        models.CheckResultRollup.failures, models.CheckResultRollup.statusCodes, 
+        models.CheckResultRollup.latencyCount, models.CheckResultRollup.latencySum,
+        models.CheckResultRollup.latencyMin, models.CheckResultRollup.latencyMax,
+        models.CheckResultRollup.latencyHistogram).where(
+            models.CheckResultRollup.period == period,
+            models.CheckResultRollup.bucketStart >= since,
+            models.CheckResultRollup.bucketStart < until,
+            models.CheckResultRollup.checkId.in_(checkIds)))
+    return result.all()
+
+async def renew_worker_lease(session: AsyncSession, workerId: str, heartbeat: datetime):
+    query = _upsert(session, models.WorkerLease).values(workerId=workerId, 
+                                                          heartbeat=heartbeat)
+    query = query.on_conflict_do_update(index_elements=[models.WorkerLease.workerId],
+                                        set_={'heartbeat': query.excluded.heartbeat})
+    await session.execute(query)
+    await session.commit()
+
+async def get_live_workers(session: AsyncSession, since: datetime) -> list[str]:
+    result = await session.execute(select(models.WorkerLease.workerId).where(
+        models.WorkerLease.heartbeat >= since).order_by(models.WorkerLease.workerId))
+    return result.scalars().all()
+
+async def delete_worker_leases(session: AsyncSession, workerId: str = None, 
+                               before: datetime = None):
+    query = delete(models.WorkerLease)
+    if workerId:
+        query = query.where(models.WorkerLease.workerId == workerId)
+    if before:
+        query = query.where(models.WorkerLease.heartbeat < before)
+    result = await session.execute(query)
+    await session.commit()
+    return result.rowcount
@@ -1,9 +1,46 @@
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-DATABASE_URL = "sqlite+aiosqlite:///./urlchecker.db"
+from . import validations
 
-engine = create_async_engine(DATABASE_URL, future=True, echo=True)
+"""This module is responsible for the database connection. SQLite databases get a
+tuned profile: write-ahead logging so readers never block the result writer,
+relaxed syncing that is still safe in WAL mode, and pooled connections that
+each have the pragmas applied once when they're opened"""
+
+settings = validations.EnvironmentSettings()
+
+DATABASE_URL = settings.database_url
+
+def create_engine(url: str):
+    options = {'future': True, 'echo': settings.database_echo}
+    if url.startswith('sqlite') and ':memory:' not in url:
+        # aiosqlite opens a new connection per session by default, pool them instead
+        options.update(poolclass=AsyncAdaptedQueuePool, 
+                       pool_size=settings.database_pool_size,
+                       max_overflow=settings.database_max_overflow)
+    elif not url.startswith('sqlite'):
+        options.update(pool_size=settings.database_pool_size,
+                       max_overflow=settings.database_max_overflow,
+                       pool_pre_ping=True)
+    return create_async_engine(url, **options)
+
+engine = create_engine(DATABASE_URL)
 OrmSession = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+@event.listens_for(engine.sync_engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # pragmas like foreign_keys only last for the connection they're set on
+    if engine.dialect.name != 'sqlite':
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode={}'.format(settings.sqlite_journal_mode))
+    cursor.execute('PRAGMA synchronous={}'.format(settings.sqlite_synchronous))
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.execute('PRAGMA busy_timeout={:d}'.format(settings.sqlite_busy_timeout))
+    cursor.execute('PRAGMA cache_size=-{:d}'.format(settings.sqlite_cache_size_kb))
+    cursor.close()
@@ -1,72 +1,466 @@
 import asyncio
+import hashlib
+import random
 import httpx
-from datetime import datetime
-from . import database, crud, validations, notifications
+from datetime import datetime, timedelta
+from . import database, crud, validations, notifications, scheduler, clients, writer, cache, sharding, metrics, broadcast
 
 """This module houses all URL check logic and job scheduling functions"""
 
 # get environment variables
 settings = validations.EnvironmentSettings()
 
+# status-only checks read at most this much of a body so that small responses
+# can hand their connection back to the pool instead of it being closed
+DRAIN_LIMIT = 64 * 1024
+
+# reconcile passes read again what was written this long before the last pass
+# started, since workers' clocks differ and writes commit after they're stamped
+RESYNC_OVERLAP = timedelta(seconds=60)
+# past this many checks missing from the cache, reading them all is quicker than by id
+MAX_MISSING_READ = 500
+
 # helper functions for job 
-async def get_receivers(session: database.AsyncSession, 
-                        check_definition_id: int):
-    receivers = await crud.get_notification_addresses_by_check_id(
-        session, check_definition_id)
-    return [x.emailAddress for x in receivers]
-
-async def get_state(response, check_definition: validations.Check):
-    if check_definition.expectedString:
-        expected_string_passes = check_definition.expectedString in response.text
-    else:
-        expected_string_passes = True
-    status_passes = response.status_code == check_definition.expectedStatus        
-    return expected_string_passes and status_passes
+async def get_receivers(check_definition_id: int):
+    receivers = cache.definition_cache.get_receivers(check_definition_id)
+    if receivers is None:
+        async with database.OrmSession() as session:
+            addresses = await crud.get_notification_addresses_by_check_id(
+                session, check_definition_id)
+        receivers = [x.emailAddress for x in addresses]
+        cache.definition_cache.set_receivers(check_definition_id, receivers)
+    return receivers
+
+async def find_expected_string(chunks, needle: bytes, max_bytes: int):
+    """Searches the body for `needle` as it streams in and stops reading as soon
+    as it's found or `max_bytes` have been read. The tail of each chunk is carried
+    over so matches that straddle two chunks aren't missed. Returns whether it was
+    found, and the length and digest of what was read to decide that."""
+    overlap = len(needle) - 1
+    carry = b''
+    bytes_read = 0
+    digest = hashlib.blake2b(digest_size=16)
+    async for chunk in chunks:
+        bytes_read += len(chunk)
+        digest.update(chunk)
+        window = carry + chunk
+        if needle in window:
+            return True, bytes_read, digest.digest()
+        if bytes_read >= max_bytes:
+            return False, bytes_read, digest.digest()
+        carry = window[-overlap:] if overlap else b''
+    return False, bytes_read, digest.digest()
+
+async def check_content(response, check_definition: validations.Check,
+                        cached: cache.ContentEntry = None, deadline: float = None):
+    """Decides whether the body contains the expected string. When it starts with
+    exactly the bytes the last verdict was reached on, that verdict stands without
+    searching. Returns the verdict and the entry to remember for next time."""
+    needle = check_definition.expectedString.encode(response.encoding or 'utf-8', 
+                                                    errors='replace')
+    max_bytes = settings.max_body_bytes
+    chunks = until_deadline(response, response.aiter_bytes(), deadline)
+    buffered = []
+    if cached is not None:
+        # a body that didn't contain the string has to end in the same place too
+        needed = cached.bodyLength
+        if not cached.passes and cached.bodyLength < max_bytes:
+            needed += 1
+        bytes_read = 0
+        async for chunk in chunks:
+            buffered.append(chunk)
+            bytes_read += len(chunk)
+            if bytes_read >= needed:
+                break
+        prefix = b''.join(buffered)[:cached.bodyLength]
+        same_verdict = (cached.passes or cached.bodyLength >= max_bytes 
+                        or bytes_read == cached.bodyLength)
+        if (same_verdict and len(prefix) == cached.bodyLength 
+                and hashlib.blake2b(prefix, digest_size=16).digest() == cached.bodyDigest):
+            metrics.content_verdicts.inc(source='body_hash')
+            return cached.passes, content_entry(response, check_definition, 
+                                                cached.bodyLength, cached.bodyDigest, 
+                                                cached.passes)
+
+    async def body():
+        for chunk in buffered:
+            yield chunk
+        async for chunk in chunks:
+            yield chunk
+
+    passes, length, digest = await find_expected_string(body(), needle, max_bytes)
+    metrics.content_verdicts.inc(source='searched')
+    return passes, content_entry(response, check_definition, length, digest, passes)
+
+def content_entry(response, check_definition: validations.Check, body_length: int, 
+                  body_digest: bytes, passes: bool) -> cache.ContentEntry:
+    return cache.ContentEntry(url=check_definition.url, 
+                              expectedString=check_definition.expectedString,
+                              statusCode=response.status_code,
+                              etag=response.headers.get('etag'),
+                              lastModified=response.headers.get('last-modified'),
+                              bodyLength=body_length, bodyDigest=body_digest, 
+                              passes=passes)
+
+def conditional_headers(cached: cache.ContentEntry = None) -> dict:
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.lastModified:
+            headers['If-Modified-Since'] = cached.lastModified
+    return headers
+
+async def until_deadline(response, chunks, deadline: float = None):
+    """Passes body chunks through until `deadline` (event loop time). httpx's own
+    timeout applies to each read separately, so without this a body that trickles
+    in could hold a check far longer than its timeout."""
+    loop = asyncio.get_running_loop()
+    async for chunk in chunks:
+        if deadline is not None and loop.time() > deadline:
+            raise httpx.ReadTimeout('body not read within the check timeout', 
+                                    request=response.request)
+        yield chunk
+
+async def discard_body(response, deadline: float = None):
+    bytes_read = 0
+    async for chunk in until_deadline(response, response.aiter_raw(), deadline):
+        bytes_read += len(chunk)
+        if bytes_read > DRAIN_LIMIT:
+            break
+
+async def send_request(check_definition: validations.Check, timeout: float):
+    """Requests the check URL, reading the body only as far as needed. Returns the
+    status code, whether the expected string was found, when the response headers
+    arrived and the response itself."""
+    client = clients.client_manager.client
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    if not check_definition.expectedString and settings.status_only_use_head:
+        response = await client.head(check_definition.url, timeout=timeout)
+        return response.status_code, True, loop.time(), response
+    if not check_definition.expectedString:
+        async with client.stream('GET', check_definition.url, timeout=timeout) as response:
+            first_byte = loop.time()
+            await discard_body(response, deadline)
+        return response.status_code, True, first_byte, response
+    cached = cache.content_cache.get(check_definition)
+    async with client.stream('GET', check_definition.url, timeout=timeout,
+                             headers=conditional_headers(cached)) as response:
+        first_byte = loop.time()
+        if response.status_code == 304 and cached is not None:
+            # unchanged since the last response, so its verdict stands
+            metrics.content_verdicts.inc(source='not_modified')
+            return cached.statusCode, cached.passes, first_byte, response
+        expected_string_passes, entry = await check_content(response, check_definition, 
+                                                            cached, deadline)
+        cache.content_cache.put(check_definition.id, entry)
+    return response.status_code, expected_string_passes, first_byte, response
+
+async def fetch(check_definition: validations.Check):
+    """Requests the check URL and returns the status code, whether the expected
+    string was found and the request timings. Content checks revalidate their
+    last response where the server supports it. httpx doesn't expose DNS, connect
+    or TLS timings, so time to first byte (response headers received) and total
+    time are what gets recorded. A request that gets no response at all, or is
+    never sent because the host's circuit is open, has status code 0."""
+    host = clients.client_manager.host(check_definition.url)
+    loop = asyncio.get_running_loop()
+    if not host.breaker.allow(loop.time()):
+        # the host is known to be down, so fail without spending a request on it
+        metrics.checks_short_circuited.inc()
+        return 0, False, {}
+    timeout = (check_definition.timeoutMs / 1000 if check_definition.timeoutMs 
+               else settings.check_timeout)
+    started = loop.time()
+    answered = False
+    try:
+        status_code, expected_string_passes, first_byte, response = (
+            await send_request(check_definition, timeout))
+        answered = True
+    except httpx.TransportError:
+        return 0, False, {}
+    except httpx.HTTPError:
+        # the host did answer, just not with anything usable
+        answered = True
+        return 0, False, {}
+    finally:
+        # reported however the request ended, since a probe that never is would
+        # keep the circuit open for good
+        if answered:
+            host.breaker.record_success()
+        else:
+            host.breaker.record_failure(loop.time())
+    finished = loop.time()
+    timings = {
+        'latencyMs': round((finished - started) * 1000),
+        'ttfbMs': round((first_byte - started) * 1000),
+        'bytesReceived': response.num_bytes_downloaded
+    }
+    return status_code, expected_string_passes, timings
+
+async def get_state(status_code: int, check_definition: validations.Check, 
+                    expected_string_passes: bool = True, latency_ms: int = None):
+    status_passes = status_code == check_definition.expectedStatus        
+    # a response slower than the check allows counts as a failure too
+    latency_passes = (not check_definition.maxLatencyMs or latency_ms is None 
+                      or latency_ms <= check_definition.maxLatencyMs)
+    return expected_string_passes and status_passes and latency_passes
 
 # main job logic
-async def run_check(check_definition: validations.Check, 
-                    client: httpx.AsyncClient, fail_count: int):
-    response = await client.get(check_definition.url)
-    success = await get_state(response, check_definition)
+async def run_check(check_definition: validations.Check, fail_count: int):
+    status_code, expected_string_passes, timings = await fetch(check_definition)
+    success = await get_state(status_code, check_definition, expected_string_passes, 
+                              timings.get('latencyMs'))
     if not success:
+        fail_count += 1
         try:
-            async with database.OrmSession() as session:
-                async with session.begin():
-                    receivers = await get_receivers(session, check_definition.id)
-            await notifications.send_alert(check_definition, receivers)
-            fail_count += 1
+            receivers = await get_receivers(check_definition.id)
+            # alerts are only queued here, the dispatcher sends them in the background
+            notifications.alert_dispatcher.send_alert(check_definition, receivers)
             if fail_count == settings.max_failures:
-                await notifications.send_admin_alert(check_definition)
+                notifications.alert_dispatcher.send_admin_alert(check_definition)
         except Exception as e:
-            # turns out that errors from smtplib are fatal to the job...
             print('Error handling failed status check: {}'.format(e))
     else:
         fail_count = 0
     check_result = validations.CheckResultBase(
         checkId=check_definition.id,
-        statusCode=response.status_code,
+        statusCode=status_code,
         state='SUCCESS' if success else 'FAILURE',
-        timeChecked=datetime.now()
+        timeChecked=datetime.now(),
+        **timings
     )
-    async with database.OrmSession() as session:
-        async with session.begin():
-            await crud.save_check_result(session, check_result)
+    metrics.checks_total.inc(state=check_result.state)
+    broadcast.result_broadcaster.publish(check_result)
+    await writer.result_writer.put(check_result)
     return fail_count
             
-# loop for job
-async def url_check_job(check_definition: validations.Check):
-    async with httpx.AsyncClient() as client:
-        fail_count = 0
-        while True:
-            fail_count = await run_check(check_definition, client, fail_count)
-            await asyncio.sleep(check_definition.frequency)
-            
+# job run by the scheduler each time a check comes due
+async def url_check_job(entry: scheduler.ScheduledCheck):
+    with metrics.check_duration.time():
+        entry.fail_count = await run_check(entry.definition, entry.fail_count)
+
+def admit_check(entry: scheduler.ScheduledCheck, resume):
+    # a check takes its host's slot before a worker, so a busy host holds back
+    # only its own checks
+    return clients.client_manager.host(entry.definition.url).admit(entry, resume)
+
+check_scheduler = scheduler.CheckScheduler(url_check_job, 
+                                           max_concurrency=settings.max_concurrent_checks,
+                                           jitter=settings.schedule_jitter,
+                                           admit=admit_check)
+
+# values tracked elsewhere that are worth exposing as metrics
+metrics.Gauge('urlchecker_scheduled_checks', 'Number of checks on the schedule', 
+              function=lambda: len(check_scheduler))
+metrics.Gauge('urlchecker_result_buffer_size', 'Check results waiting to be written', 
+              function=writer.result_writer.pending)
+metrics.Gauge('urlchecker_alert_queue_size', 'Alert e-mails waiting to be sent', 
+              function=notifications.alert_dispatcher.pending)
+metrics.Gauge('urlchecker_open_circuits', 'Hosts whose circuit is open after repeated failures', 
+              function=lambda: clients.client_manager.open_circuits())
+metrics.Gauge('urlchecker_checks_waiting_for_host', 'Due checks held back by their host\'s connection limit', 
+              function=lambda: clients.client_manager.waiting())
+metrics.Gauge('urlchecker_content_cache_size', 'Content checks whose last response is remembered', 
+              function=lambda: len(cache.content_cache))
+metrics.Counter('urlchecker_definition_cache_hits_total', 'Receiver lookups served from memory', 
+                function=lambda: cache.definition_cache.hits)
+metrics.Counter('urlchecker_definition_cache_misses_total', 'Receiver lookups that read the database', 
+                function=lambda: cache.definition_cache.misses)
+
 # scheduling utilities
-async def cancel_task_by_name(name: str):
-    for task in asyncio.all_tasks():
-        if task.get_name() == name:
-            try: 
-                task.cancel()
-                await task
-            except asyncio.CancelledError:
-                pass  # this exception is raised as a confirmation the task was canceled
\ No newline at end of file
+def schedule_check(check_definition: validations.Check):
+    """Schedules a check if this worker owns it, or updates it in place if it's
+    already scheduled. Checks owned by other workers are picked up by them on
+    their next reconcile."""
+    if sharding.shard_coordinator.owns(check_definition.id):
+        check_scheduler.update(check_definition)
+    else:
+        check_scheduler.remove(check_definition.id)
+
+def schedule_checks(check_definitions: list[validations.Check]):
+    """Schedules many checks at once, like a bulk import. First runs are spread
+    over each check's whole frequency instead of the usual jitter window, and
+    checks that are already scheduled keep their place."""
+    for check_definition in check_definitions:
+        if not sharding.shard_coordinator.owns(check_definition.id):
+            check_scheduler.remove(check_definition.id)
+        elif check_definition.id in check_scheduler:
+            check_scheduler.update(check_definition)
+        else:
+            check_scheduler.add(check_definition, 
+                                delay=random.uniform(0, check_definition.frequency))
+
+def resume_check(check_definition: validations.Check, db_schedule, 
+                 catchup_window: float, now: datetime) -> scheduler.ScheduledCheck:
+    """Schedules a check where its saved schedule left it, with its failure count.
+    Overdue checks, and ones that were never saved, are spread over
+    `catchup_window` seconds (or their frequency, if that's shorter)."""
+    frequency = max(check_definition.frequency, 1)
+    if db_schedule is not None and db_schedule.nextDue > now:
+        delay = min((db_schedule.nextDue - now).total_seconds(), frequency)
+    else:
+        delay = random.uniform(0, min(catchup_window, frequency))
+    entry = check_scheduler.add(check_definition, delay=delay)
+    if db_schedule is not None:
+        entry.fail_count = db_schedule.failCount or 0
+    return entry
+
+async def resume_checks(checkIds: list[int], page_size: int, catchup_window: float):
+    """Schedules checks this worker has just taken on, like another worker's
+    shard, from their saved schedules a page at a time"""
+    for start in range(0, len(checkIds), page_size):
+        page = checkIds[start:start + page_size]
+        async with database.OrmSession() as session:
+            db_schedules = {x.checkId: x for x in await crud.get_schedules(session, page)}
+        now = datetime.now()
+        for checkId in page:
+            check_definition = cache.definition_cache.get_definition(checkId)
+            # the check may have been scheduled, deleted or moved on meanwhile
+            if (check_definition is None or checkId in check_scheduler 
+                    or not sharding.shard_coordinator.owns(checkId)):
+                continue
+            resume_check(check_definition, db_schedules.get(checkId), catchup_window, now)
+            metrics.reconciled_checks.inc(action='added')
+
+async def rebalance(checkIds: set = None):
+    """Makes the schedule match the definition cache: checks this worker owns are
+    added or updated in place, and everything else is removed. Added checks
+    resume their saved schedule. Only `checkIds` are looked at when given,
+    otherwise every cached or scheduled check is."""
+    if checkIds is None:
+        checkIds = cache.definition_cache.check_ids() | set(check_scheduler.check_ids())
+    added = []
+    for checkId in checkIds:
+        check_definition = cache.definition_cache.get_definition(checkId)
+        entry = check_scheduler.get(checkId)
+        if check_definition is None or not sharding.shard_coordinator.owns(checkId):
+            if entry is not None:
+                check_scheduler.remove(checkId)
+                metrics.reconciled_checks.inc(action='removed')
+        elif entry is None:
+            added.append(checkId)
+        # pydantic's == builds a dict of each side, which is most of a full pass
+        elif (entry.definition is not check_definition 
+                and entry.definition.__dict__ != check_definition.__dict__):
+            check_scheduler.update(check_definition)
+            metrics.reconciled_checks.inc(action='updated')
+    if added:
+        await resume_checks(added, settings.startup_page_size, 
+                            settings.startup_catchup_window)
+
+async def sync_definitions() -> set:
+    """Brings the definition cache up to date with the database, which other
+    workers may have written to. Only definitions written since the last pass and
+    ones missing from the cache are read, and checks the database no longer has
+    are dropped. Returns the ids of the checks that were read or dropped."""
+    mark = cache.definition_cache.mark()
+    known = cache.definition_cache.check_ids()
+    synced_at = cache.definition_cache.synced_at
+    started = datetime.now()
+    async with database.OrmSession() as session:
+        checkIds = await crud.get_check_ids(session)
+        missing = list(checkIds - known)
+        if synced_at is None or len(missing) > MAX_MISSING_READ:
+            rows = await crud.get_check_defintions(session)
+            pairs = await crud.get_receiver_pairs(session)
+        else:
+            # address writes mark their checks as written, so the addresses of
+            # the definitions read are the only ones that can have changed
+            rows = await crud.get_changed_check_definitions(
+                session, synced_at - RESYNC_OVERLAP, missing)
+            pairs = await crud.get_receiver_pairs(session, [x.id for x in rows])
+    receivers = {x.id: [] for x in rows}
+    for checkId, emailAddress in pairs:
+        if checkId in receivers:
+            receivers[checkId].append(emailAddress)
+    removed = known - checkIds
+    cache.definition_cache.merge([cache.to_check(x) for x in rows], mark, 
+                                 removed=removed, receivers=receivers)
+    cache.definition_cache.synced_at = started
+    return {x.id for x in rows} | removed
+
+async def resync_checks():
+    # ownership may have moved, so every check is looked at, not only changed ones
+    await sync_definitions()
+    await rebalance()
+
+async def reconcile_checks():
+    await rebalance(await sync_definitions())
+
+async def load_checks(page_size: int, catchup_window: float):
+    """Loads definitions a page at a time and schedules the ones this worker owns
+    as each page arrives, so checks start running before the last page is read.
+    Checks resume their saved schedule and failure count. Overdue ones, and ones
+    that were never saved, are spread over `catchup_window` seconds (or their
+    frequency, if that's shorter) so a restart doesn't run them all at once."""
+    after_id = 0
+    started = datetime.now()
+    while True:
+        mark = cache.definition_cache.mark()
+        try:
+            async with database.OrmSession() as session:
+                rows = await crud.get_schedule_page(session, after_id, page_size)
+                addresses = await crud.get_addresses_for_checks(
+                    session, [x.id for x, _ in rows])
+        except Exception as e:
+            # the reconciler schedules whatever wasn't loaded on its next pass
+            print('Error loading check definitions: {}'.format(e))
+            return
+        if not rows:
+            # what was written while this was loading is on or after `started`,
+            # so reconciling can read only what changed from here on
+            if cache.definition_cache.synced_at is None:
+                cache.definition_cache.synced_at = started
+            return
+        after_id = rows[-1][0].id
+        # receivers are cached with their checks, so failures don't read them
+        receivers = {x.id: [] for x, _ in rows}
+        for address in addresses:
+            receivers[address.checkId].append(address.emailAddress)
+        cache.definition_cache.merge([cache.to_check(x) for x, _ in rows], mark, 
+                                     receivers=receivers)
+        now = datetime.now()
+        for db_check_definition, db_schedule in rows:
+            # checks created or reconciled while this was loading are already set,
+            # and ones deleted meanwhile aren't in the cache
+            check_definition = cache.definition_cache.get_definition(db_check_definition.id)
+            if (check_definition is None or check_definition.id in check_scheduler 
+                    or not sharding.shard_coordinator.owns(check_definition.id)):
+                continue
+            resume_check(check_definition, db_schedule, catchup_window, now)
+
+class Reconciler:
+    """Resyncs the schedule with the database every `interval` seconds, which
+    picks up definitions changed by other workers or outside the API. Changes made
+    with SQL outside the API, to definitions or their addresses, must set the
+    definition's updatedAt to be picked up."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await reconcile_checks()
+            except Exception as e:
+                print('Error reconciling checks: {}'.format(e))
+
+    def start(self):
+        if self.interval:
+            self._task = asyncio.create_task(self._run(), name='check-reconciler')
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+check_reconciler = Reconciler(interval=settings.reconcile_interval)
@@ -0,0 +1,228 @@
+import asyncio
+import bisect
+import time
+from contextlib import contextmanager
+from starlette.routing import Match
+
+"""This module is responsible for the checker's own instrumentation. The metric
+types are deliberately small: recording a value is a dict lookup and an addition,
+and everything is rendered in the Prometheus text format only when scraped"""
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = []
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Base for all metric types. Passing `function` makes the metric read its
+    value from it at scrape time, for values that are already tracked elsewhere."""
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (),
+                 function=None):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, '', self.function()
+            return
+        if not self.labelnames and not self._values:
+            # unlabelled series are reported from the start, not from first use
+            yield self.name, '', 0
+            return
+        for key, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        """The value summed over every label set"""
+        return sum(self._values.values())
+
+    def render(self) -> str:
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, labels, _format_value(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            # per-bucket counts, then the running sum and the total count
+            series = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def get(self, **labels):
+        series = self._values.get(self._key(labels))
+        return (series[-2], series[-1]) if series else (0.0, 0)
+
+    def total(self):
+        """The sum and count of observations over every label set"""
+        return (sum(series[-2] for series in self._values.values()),
+                sum(series[-1] for series in self._values.values()))
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       _format_labels(self.labelnames, key, 'le="{}"'.format(bound)),
+                       cumulative)
+            yield (self.name + '_bucket',
+                   _format_labels(self.labelnames, key, 'le="+Inf"'), series[-1])
+            yield self.name + '_sum', _format_labels(self.labelnames, key), series[-2]
+            yield self.name + '_count', _format_labels(self.labelnames, key), series[-1]
+
+class RequestMetricsMiddleware:
+    """ASGI middleware timing API requests up to the start of the response, by
+    route template so /checkdefinitions/1 and /checkdefinitions/2 share a series.
+    Timing to the response start keeps long-lived streams from skewing it."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def _route(self, scope) -> str:
+        for route in scope['app'].routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, 'path', scope['path'])
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        responded = False
+
+        def observe(status: int):
+            http_request_duration.observe(time.perf_counter() - started,
+                                          method=scope['method'],
+                                          route=self._route(scope), status=status)
+
+        async def send_and_observe(message):
+            nonlocal responded
+            if message['type'] == 'http.response.start':
+                responded = True
+                observe(message['status'])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_observe)
+        finally:
+            if not responded:
+                observe(500)
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Measures how late a timer fires, which grows when the loop is saturated"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.set(max(loop.time() - started - interval, 0))
+
+# the checker's metrics
+schedule_lag = Histogram('urlchecker_schedule_lag_seconds',
+                         'How long after its due time a check started running')
+checks_in_flight = Gauge('urlchecker_checks_in_flight',
+                         'Number of checks currently running')
+check_duration = Histogram('urlchecker_check_duration_seconds',
+                           'Time taken by run_check, including queueing the result')
+checks_total = Counter('urlchecker_checks_total',
+                       'Completed checks by resulting state', ('state',))
+content_verdicts = Counter('urlchecker_content_verdicts_total',
+                           'Expected string verdicts by how they were reached '
+                           '(searched, not_modified or body_hash)', ('source',))
+checks_short_circuited = Counter('urlchecker_checks_short_circuited_total',
+                                 'Checks failed without a request because their '
+                                 "host's circuit was open")
+reconciled_checks = Counter('urlchecker_reconciled_checks_total',
+                            'Schedule changes made to match the database, by action',
+                            ('action',))
+check_errors = Counter('urlchecker_check_errors_total',
+                       'Checks that raised instead of producing a result')
+db_write_duration = Histogram('urlchecker_db_write_seconds',
+                              'Time taken to write one batch of check results')
+results_written = Counter('urlchecker_results_written_total',
+                          'Check results persisted to the database')
+results_dropped = Counter('urlchecker_results_dropped_total',
+                          'Check results that were never written, by reason '
+                          '(check_deleted or write_failed)', ('reason',))
+alert_send_duration = Histogram('urlchecker_alert_send_seconds',
+                                'Time taken to hand one alert e-mail to the SMTP server')
+alerts_total = Counter('urlchecker_alerts_total',
+                       'Alert e-mails by outcome', ('outcome',))
+http_request_duration = Histogram('urlchecker_http_request_duration_seconds',
+                                  'API request handling time',
+                                  ('method', 'route', 'status'))
+response_cache_lookups = Counter('urlchecker_response_cache_lookups_total',
+                                 'Read API requests by whether the response cache '
+                                 'answered them (hit or miss)', ('result',))
+live_subscribers_dropped = Counter('urlchecker_live_subscribers_dropped_total',
+                                   'Live result streams dropped for falling behind')
+event_loop_lag = Gauge('urlchecker_event_loop_lag_seconds',
+                       'How late the most recent event loop probe timer fired')
@@ -0,0 +1,104 @@
+from datetime import datetime
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData, inspect, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from . database import Base
+# the models have to be imported for their tables to be part of Base.metadata
+from . import models, search
+
+"""This module is responsible for bringing the database schema up to date at
+startup. Migrations run once each, in order, and the schema_migrations table
+records which ones a database has had. New schema changes go on the end of
+MIGRATIONS and must be safe to run against a database that already has them,
+since several workers may start at the same time"""
+
+# kept out of Base.metadata so dropping the app's tables leaves it alone
+migration_metadata = MetaData()
+schema_migrations = Table('schema_migrations', migration_metadata,
+                          Column('version', Integer, primary_key=True),
+                          Column('name', String),
+                          Column('appliedAt', DateTime))
+
+def create_tables(connection):
+    """Creates any missing tables, with their indexes"""
+    Base.metadata.create_all(connection)
+
+def add_missing_columns(connection):
+    """create_all only creates missing tables, so columns added to the models of
+    tables that already existed are added here. Such columns must be nullable."""
+    inspector = inspect(connection)
+    quote = connection.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    quote(table.name), quote(column.name),
+                    column.type.compile(connection.dialect))))
+
+def create_missing_indexes(connection):
+    """Adds indexes that were added to the models of tables that already existed"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+def baseline(connection):
+    # databases from before migrations existed may be missing any of what
+    # came after, so the first migration fills in whatever is absent
+    create_tables(connection)
+    add_missing_columns(connection)
+
+def track_definition_changes(connection):
+    add_missing_columns(connection)
+    create_missing_indexes(connection)
+    # definitions from before the column count as changed now, which the first
+    # reconcile pass reads anyway
+    definitions = models.CheckDefinition.__table__
+    connection.execute(definitions.update().where(
+        definitions.c.updatedAt.is_(None)).values(updatedAt=datetime.now()))
+
+# (version, name, function) in the order they're applied
+MIGRATIONS = [
+    (1, 'baseline schema', baseline),
+    (2, 'result, rollup and notification address indexes', create_missing_indexes),
+    # results that are still raw were never rolled up before this, and a
+    # watermark of zero makes the first roll up pass include all of them
+    (3, 'continuous rollups with latency histograms', baseline),
+    (4, 'per check timeouts', add_missing_columns),
+    (5, 'persisted schedule state', create_tables),
+    (6, 'url search index', search.url_index.create),
+    (7, 'definition change tracking', track_definition_changes),
+]
+
+def applied_versions(connection) -> set:
+    result = connection.execute(select(schema_migrations.c.version))
+    return set(result.scalars().all())
+
+def record_version(connection, version: int, name: str):
+    # another worker may have just applied the same migration, that's fine
+    if connection.dialect.name == 'postgresql':
+        query = postgresql.insert(schema_migrations)
+    else:
+        query = sqlite.insert(schema_migrations)
+    connection.execute(query.on_conflict_do_nothing(index_elements=['version']),
+                       {'version': version, 'name': name, 'appliedAt': datetime.now()})
+
+def run_migrations(connection):
+    """Applies every migration the database hasn't had yet. Meant to be passed to
+    AsyncConnection.run_sync inside a transaction."""
+    migration_metadata.create_all(connection)
+    applied = applied_versions(connection)
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        print('Applying database migration {}: {}'.format(version, name))
+        migrate(connection)
+        record_version(connection, version, name)
+
+def drop_schema(connection):
+    """Drops every table, including the migration history"""
+    search.url_index.drop(connection)
+    Base.metadata.drop_all(connection)
+    migration_metadata.drop_all(connection)
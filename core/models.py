@@ -1,4 +1,5 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
+from datetime import datetime
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 
 from . database import Base
@@ -16,6 +17,10 @@ class CheckDefinition(Base):
     frequency = Column(Integer)
     expectedStatus = Column(Integer)
     expectedString = Column(String)
+    maxLatencyMs = Column(Integer)
+    timeoutMs = Column(Integer)
+    # when the definition was last written, so reconciling reads only what changed
+    updatedAt = Column(DateTime, default=datetime.now, onupdate=datetime.now, index=True)
 
     results = relationship('CheckResult', 
                            back_populates='checkDefinition', 
@@ -30,6 +35,8 @@ class CheckDefinition(Base):
 
 class CheckResult(Base):
     __tablename__ = 'results'
+    # history queries filter on the check and walk it by time
+    __table_args__ = (Index('ix_results_checkId_timeChecked', 'checkId', 'timeChecked'),)
 
     id = Column(Integer, primary_key=True, index=True)
     checkId = Column(Integer, ForeignKey('definitions.id', 
@@ -37,18 +44,75 @@ class CheckResult(Base):
     timeChecked = Column(DateTime)
     statusCode = Column(Integer)
     state = Column(String)
+    # timings are whole milliseconds
+    latencyMs = Column(Integer)
+    ttfbMs = Column(Integer)
+    bytesReceived = Column(Integer)
 
     checkDefinition = relationship('CheckDefinition', 
                                    back_populates='results', 
                                    uselist=False, 
                                    lazy='selectin')
 
+class LatestResult(Base):
+    # one row per check holding its most recent result, kept up to date as
+    # results are written so the dashboard never has to scan the results table
+    __tablename__ = 'latest_results'
+
+    checkId = Column(Integer, ForeignKey('definitions.id', 
+                                         ondelete='CASCADE'), 
+                     primary_key=True)
+    timeChecked = Column(DateTime)
+    statusCode = Column(Integer)
+    state = Column(String)
+    latencyMs = Column(Integer)
+
+class CheckSchedule(Base):
+    # where each check was in its schedule, saved periodically so a restart can
+    # resume it instead of running every check at once
+    __tablename__ = 'check_schedules'
+
+    checkId = Column(Integer, ForeignKey('definitions.id', 
+                                         ondelete='CASCADE'), 
+                     primary_key=True)
+    nextDue = Column(DateTime)
+    failCount = Column(Integer)
+
+class CheckResultRollup(Base):
+    # aggregates of raw results, kept up to date shortly after results are written
+    # and kept on after the raw results have aged out of the retention window
+    __tablename__ = 'result_rollups'
+    __table_args__ = (UniqueConstraint('checkId', 'period', 'bucketStart'),
+                      Index('ix_result_rollups_period_bucketStart', 'period', 'bucketStart'))
+
+    id = Column(Integer, primary_key=True, index=True)
+    checkId = Column(Integer, ForeignKey('definitions.id', 
+                                         ondelete='CASCADE'))
+    period = Column(String) # 'hour' or 'day'
+    bucketStart = Column(DateTime)
+    count = Column(Integer)
+    failures = Column(Integer)
+    statusCodes = Column(String) # JSON object of status code -> count
+    latencyCount = Column(Integer)
+    latencySum = Column(Integer)
+    latencyMin = Column(Integer)
+    latencyMax = Column(Integer)
+    latencyHistogram = Column(String) # JSON object of bucket upper bound -> count
+
+class RollupWatermark(Base):
+    # the id of the last result included in the rollups, results are rolled up
+    # in id order so everything at or below it has been counted
+    __tablename__ = 'rollup_watermarks'
+
+    name = Column(String, primary_key=True)
+    lastResultId = Column(Integer)
+
 class NotificationAddress(Base):
     __tablename__ = 'notification_addresses'
 
     id = Column(Integer, primary_key=True, index=True)
     checkId = Column(Integer, ForeignKey('definitions.id', 
-                                         ondelete='CASCADE'))
+                                         ondelete='CASCADE'), index=True)
     emailAddress = Column(String)
 
     checkDefinition = relationship('CheckDefinition', 
@@ -56,3 +120,11 @@ class NotificationAddress(Base):
                                    uselist=False, 
                                    lazy='selectin')
 
+
+class WorkerLease(Base):
+    # every running worker process renews its row here, so the live rows tell
+    # each worker which others are alive when dividing up the checks
+    __tablename__ = 'worker_leases'
+
+    workerId = Column(String, primary_key=True)
+    heartbeat = Column(DateTime)
@@ -2,10 +2,10 @@ import aiosmtplib
 import asyncio
 from typing import List
 from email.message import EmailMessage
-from . import validations
+from . import validations, metrics
 
 settings = validations.EnvironmentSettings()
-   
+
 server_conf = {
     'hostname': settings.smtp_server,
     'username': settings.smtp_username,
@@ -14,24 +14,174 @@ server_conf = {
     'use_tls': settings.smtp_use_tls
 }
 
-async def send_admin_alert(check_definition: validations.Check):
+def build_admin_alert(check_definition: validations.Check, suppressed: int = 0):
     message = EmailMessage()
     message['From'] = settings.sender_email
     message['To'] = settings.admin_email
     message['Subject'] = f'{check_definition.url} is in a failure state for 3 or more times'
-    message.set_content(f'CheckId {check_definition.id} for URL {check_definition.url}' 
-                        'has failed 3 or more times. Admin attention may be required to ensure no issue is present')
-    await aiosmtplib.send(message, **server_conf)
+    message.set_content(f'CheckId {check_definition.id} for URL {check_definition.url} '
+                        'has failed 3 or more times. Admin attention may be required to ensure no issue is present'
+                        + suppressed_note(suppressed))
+    return message
 
-async def send_alert(check_definition: validations.Check, receivers: List[str]):
+def build_alert(check_definition: validations.Check, receivers: List[str],
+                suppressed: int = 0):
+    # one message addressed to every receiver rather than one message each
     message = EmailMessage()
     message['From'] = settings.sender_email
+    message['To'] = ', '.join(receivers)
     message['Subject'] = f'{check_definition.url} check has failed'
-    message.set_content(f'CheckId {check_definition.id} for URL {check_definition.url}' 
-                        'is in a failure state.')
-    for email_address in receivers:
-        message['To'] = email_address
-        await aiosmtplib.send(message, **server_conf)
+    message.set_content(f'CheckId {check_definition.id} for URL {check_definition.url} '
+                        'is in a failure state.' + suppressed_note(suppressed))
+    return message
+
+def suppressed_note(suppressed: int):
+    if not suppressed:
+        return ''
+    return f'\n\n{suppressed} further alert(s) for this check were held back since the last e-mail.'
+
+class Delivery:
+    """A message waiting to be sent, along with how often sending it has failed"""
+    __slots__ = ('message', 'attempts')
+
+    def __init__(self, message: EmailMessage):
+        self.message = message
+        self.attempts = 0
+
+class AlertDispatcher:
+    """Sends alert e-mails from a queue so the check path never waits on the mail
+    server. Each of the `pool_size` senders keeps its own SMTP connection open
+    between messages. Repeat alerts for the same check within `cooldown` seconds
+    are held back and summarised in the next alert that does go out."""
+
+    def __init__(self, server_conf: dict, pool_size: int, queue_size: int,
+                 cooldown: float, max_retries: int, retry_delay: float,
+                 idle_timeout: float):
+        self.server_conf = server_conf
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.cooldown = cooldown
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self._last_sent = {}
+        self._suppressed = {}
+        # the queue is bound to the running loop, so it's created in start()
+        self._queue = None
+        self._tasks = []
+
+    def _coalesce(self, key) -> int:
+        """Returns how many alerts were held back for `key`, or None if this
+        alert is itself within the cooldown and should be held back too"""
+        now = asyncio.get_event_loop().time()
+        last_sent = self._last_sent.get(key)
+        if last_sent is not None and now - last_sent < self.cooldown:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            metrics.alerts_total.inc(outcome='suppressed')
+            return None
+        self._last_sent[key] = now
+        return self._suppressed.pop(key, 0)
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _enqueue(self, delivery: Delivery):
+        try:
+            self._queue.put_nowait(delivery)
+        except asyncio.QueueFull:
+            metrics.alerts_total.inc(outcome='dropped')
+            print('Alert queue is full, dropping alert: {}'.format(delivery.message['Subject']))
+
+    def send_alert(self, check_definition: validations.Check, receivers: List[str]):
+        if not receivers:
+            return
+        suppressed = self._coalesce(check_definition.id)
+        if suppressed is not None:
+            self._enqueue(Delivery(build_alert(check_definition, receivers, suppressed)))
+
+    def send_admin_alert(self, check_definition: validations.Check):
+        suppressed = self._coalesce(('admin', check_definition.id))
+        if suppressed is not None:
+            self._enqueue(Delivery(build_admin_alert(check_definition, suppressed)))
+
+    def _retry(self, delivery: Delivery):
+        delivery.attempts += 1
+        if delivery.attempts > self.max_retries:
+            metrics.alerts_total.inc(outcome='abandoned')
+            print('Giving up on alert after {} attempts: {}'.format(
+                delivery.attempts, delivery.message['Subject']))
+            return
+        # back off without holding up a sender while we wait
+        delay = self.retry_delay * 2 ** (delivery.attempts - 1)
+        asyncio.get_event_loop().call_later(delay, self._enqueue, delivery)
+
+    async def _deliver(self, smtp: aiosmtplib.SMTP, delivery: Delivery):
+        with metrics.alert_send_duration.time():
+            if not smtp.is_connected:
+                await smtp.connect()
+            await smtp.send_message(delivery.message)
+        metrics.alerts_total.inc(outcome='sent')
+
+    async def _send(self):
+        smtp = aiosmtplib.SMTP(**self.server_conf)
+        try:
+            while True:
+                try:
+                    delivery = await asyncio.wait_for(self._queue.get(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    # servers drop idle connections anyway, so let ours go first
+                    if smtp.is_connected:
+                        try:
+                            await smtp.quit()
+                        except aiosmtplib.SMTPException:
+                            smtp.close()
+                    continue
+                try:
+                    await self._deliver(smtp, delivery)
+                except aiosmtplib.SMTPServerDisconnected:
+                    # the pooled connection went stale, reconnect once right away
+                    try:
+                        smtp.close()
+                        await self._deliver(smtp, delivery)
+                    except Exception as e:
+                        metrics.alerts_total.inc(outcome='failed')
+                        print('Error sending alert: {}'.format(e))
+                        self._retry(delivery)
+                except Exception as e:
+                    metrics.alerts_total.inc(outcome='failed')
+                    print('Error sending alert: {}'.format(e))
+                    # a rejected message leaves the session usable, anything else doesn't
+                    if not isinstance(e, aiosmtplib.SMTPResponseException):
+                        smtp.close()
+                    self._retry(delivery)
+                finally:
+                    self._queue.task_done()
+        finally:
+            smtp.close()
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._send(), name='alert-sender-{}'.format(i))
+                       for i in range(self.pool_size)]
+
+    async def stop(self, timeout: float = 10):
+        """Gives queued alerts up to `timeout` seconds to go out before stopping"""
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                print('Stopping with {} alert(s) unsent'.format(self._queue.qsize()))
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+alert_dispatcher = AlertDispatcher(server_conf, pool_size=settings.smtp_pool_size,
+                                   queue_size=settings.alert_queue_size,
+                                   cooldown=settings.alert_cooldown,
+                                   max_retries=settings.alert_max_retries,
+                                   retry_delay=settings.alert_retry_delay,
+                                   idle_timeout=settings.smtp_idle_timeout)
 
 
 if __name__ == '__main__':
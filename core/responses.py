@@ -0,0 +1,98 @@
+import hashlib
+import json
+import time
+from datetime import datetime
+from fastapi import Request, Response, status
+from . import validations, cache, metrics
+
+"""This module is responsible for answering the read endpoints cheaply. Responses
+are encoded to JSON straight from the database rows, without building a pydantic
+model per row, and the encoded body is kept in the response cache until a write
+touches what it was built from. Every response carries an ETag, so clients that
+send it back in If-None-Match get an empty 304 while nothing has changed"""
+
+def _fields(model, *nested: str) -> tuple:
+    # the output models' own field order, less the nested fields filled in separately
+    return tuple(name for name in model.__fields__ if name not in nested)
+
+ADDRESS_FIELDS = _fields(validations.NotificationAddress)
+DEFINITION_FIELDS = _fields(validations.Check, 'emailAddresses')
+RESULT_FIELDS = _fields(validations.CheckResult, 'checkDefinition')
+RESULT_BASE_FIELDS = _fields(validations.CheckResultBase)
+LATEST_RESULT_FIELDS = _fields(validations.LatestResult)
+
+def result_topics(checkIds: list) -> tuple:
+    """Topics of a response built from the results of the given checks only, which
+    unlike other results-backed responses is kept current with every flush"""
+    return ('definitions', 'addresses', 'results') + tuple(('results', x) for x in checkIds)
+
+def to_dict(row, fields: tuple) -> dict:
+    return {name: getattr(row, name) for name in fields}
+
+def definition_dicts(definitions: list, addresses: list) -> list[dict]:
+    """Definition rows with the given address rows nested under their checks"""
+    nested = {x.id: [] for x in definitions}
+    for address in addresses:
+        nested.setdefault(address.checkId, []).append(to_dict(address, ADDRESS_FIELDS))
+    return [dict(to_dict(x, DEFINITION_FIELDS), emailAddresses=nested[x.id])
+            for x in definitions]
+
+def result_dicts(results: list, definitions: dict = None) -> list[dict]:
+    """Result rows, each with its definition from `definitions` (keyed by check id)
+    nested when given. Results of one check share the one definition dict."""
+    definitions = definitions or {}
+    return [dict(to_dict(x, RESULT_FIELDS), checkDefinition=definitions.get(x.checkId))
+            for x in results]
+
+def _default(value):
+    # the same format pydantic gives datetimes
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+def encode(content) -> bytes:
+    # the same options FastAPI's JSONResponse uses
+    return json.dumps(content, default=_default, ensure_ascii=False, allow_nan=False,
+                      separators=(',', ':')).encode('utf-8')
+
+def make_etag(body: bytes) -> str:
+    return '"{}"'.format(hashlib.blake2b(body, digest_size=16).hexdigest())
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # weak comparison, since proxies that compress a body mark its ETag weak
+    tags = [x.strip() for x in if_none_match.split(',')]
+    return '*' in tags or etag in (x[2:] if x.startswith('W/') else x for x in tags)
+
+def respond(request: Request, entry: cache.CachedResponse) -> Response:
+    # no-cache lets clients keep the body but makes them revalidate it every time
+    headers = dict(entry.headers, ETag=entry.etag)
+    headers['Cache-Control'] = 'no-cache'
+    if (entry.statusCode == status.HTTP_200_OK
+            and etag_matches(request.headers.get('if-none-match'), entry.etag)):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(entry.body, status_code=entry.statusCode, headers=headers,
+                    media_type='application/json')
+
+async def cached(request: Request, topics: tuple, build) -> Response:
+    """Answers `request` from the response cache, or on a miss with what `build`
+    makes, which is a coroutine function returning the status code, the content
+    (plain lists, dicts and datetimes) and any headers. `topics` are what the
+    content is built from, so writes to them invalidate it."""
+    key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+    now = time.monotonic()
+    entry = cache.response_cache.get(key, now)
+    if entry is None:
+        metrics.response_cache_lookups.inc(result='miss')
+        versions = cache.response_cache.versions(topics)
+        statusCode, content, headers = await build()
+        body = encode(content)
+        entry = cache.response_cache.put(key, statusCode, body, headers, make_etag(body),
+                                         topics, versions, now)
+    else:
+        metrics.response_cache_lookups.inc(result='hit')
+    return respond(request, entry)
+
+metrics.Gauge('urlchecker_response_cache_bytes', 'Encoded API responses held in memory',
+              function=lambda: cache.response_cache.size())
@@ -0,0 +1,211 @@
+import asyncio
+import bisect
+import json
+from collections import Counter
+from datetime import datetime, timedelta
+from . import database, crud, models, validations, sharding, cache
+
+"""This module is responsible for rolling check results up into hourly and daily
+aggregates per check, and for keeping the results table bounded. Results are
+rolled up shortly after they're written, tracked by a watermark on result id so
+each is counted exactly once. Raw results older than the retention window are
+then only deleted, one small transaction at a time"""
+
+# get environment variables
+settings = validations.EnvironmentSettings()
+
+PERIODS = {
+    'hour': lambda t: t.replace(minute=0, second=0, microsecond=0),
+    'day': lambda t: t.replace(hour=0, minute=0, second=0, microsecond=0)
+}
+
+# latency histogram bucket upper bounds in milliseconds, each about 10% above the
+# last, so percentiles read from a histogram are within about 10% of the truth
+LATENCY_BOUNDS = [1]
+while LATENCY_BOUNDS[-1] < 300000:
+    LATENCY_BOUNDS.append(max(LATENCY_BOUNDS[-1] + 1, round(LATENCY_BOUNDS[-1] * 1.1)))
+
+def latency_bound(latency_ms: int) -> int:
+    index = bisect.bisect_left(LATENCY_BOUNDS, latency_ms)
+    return LATENCY_BOUNDS[min(index, len(LATENCY_BOUNDS) - 1)]
+
+class Rollup:
+    """In-memory aggregate for one (check, period, bucket) combination"""
+    __slots__ = ('count', 'failures', 'status_codes', 'latencies', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.status_codes = Counter()
+        self.latencies = []
+        self.histogram = Counter()
+
+    def add(self, row):
+        self.count += 1
+        if row.state != 'SUCCESS':
+            self.failures += 1
+        self.status_codes[str(row.statusCode)] += 1
+        if row.latencyMs is not None:
+            self.latencies.append(row.latencyMs)
+            self.histogram[str(latency_bound(row.latencyMs))] += 1
+
+    def merged_with(self, db_rollup: models.CheckResultRollup = None) -> dict:
+        """The column values of this rollup added to a stored one, if there is one"""
+        values = {'count': self.count, 'failures': self.failures}
+        status_codes = Counter(self.status_codes)
+        histogram = Counter(self.histogram)
+        latencies = self.latencies
+        low = min(latencies) if latencies else None
+        high = max(latencies) if latencies else None
+        latency_count, latency_sum = len(latencies), sum(latencies)
+        if db_rollup is not None:
+            values['count'] += db_rollup.count
+            values['failures'] += db_rollup.failures
+            status_codes.update(json.loads(db_rollup.statusCodes or '{}'))
+            histogram.update(json.loads(db_rollup.latencyHistogram or '{}'))
+            latency_count += db_rollup.latencyCount or 0
+            latency_sum += db_rollup.latencySum or 0
+            if db_rollup.latencyMin is not None:
+                low = db_rollup.latencyMin if low is None else min(low, db_rollup.latencyMin)
+                high = db_rollup.latencyMax if high is None else max(high, db_rollup.latencyMax)
+        values.update(statusCodes=json.dumps(status_codes), latencyMin=low, latencyMax=high,
+                      latencyCount=latency_count or None, latencySum=latency_sum or None,
+                      latencyHistogram=json.dumps(histogram) if histogram else None)
+        return values
+
+def aggregate(rows) -> dict:
+    rollups = {}
+    for row in rows:
+        for period, truncate in PERIODS.items():
+            key = (row.checkId, period, truncate(row.timeChecked))
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = rollups[key] = Rollup()
+            rollup.add(row)
+    return rollups
+
+async def save_rollups(session: database.AsyncSession, rollups: dict):
+    # one statement for all new rows and one for all changed ones, rather than a
+    # statement per rollup, keeps the write lock short with thousands of checks
+    new, changed = [], []
+    for period in PERIODS:
+        buckets = [key[2] for key in rollups if key[1] == period]
+        existing = await crud.get_rollups(session, period, min(buckets), max(buckets))
+        existing = {(x.checkId, x.period, x.bucketStart): x for x in existing}
+        for key, rollup in rollups.items():
+            if key[1] != period:
+                continue
+            db_rollup = existing.get(key)
+            values = rollup.merged_with(db_rollup)
+            if db_rollup is None:
+                new.append(dict(values, checkId=key[0], period=period, bucketStart=key[2]))
+            else:
+                changed.append(dict(values, rollupId=db_rollup.id))
+    await crud.save_rollups(session, new, changed)
+
+class ResultCompactor:
+    """Rolls new results up every `rollup_interval` seconds and deletes expired
+    ones every `interval` seconds. Each batch is its own transaction so the write
+    lock is only ever held briefly and result writes can interleave."""
+
+    def __init__(self, raw_retention: timedelta, hourly_retention: timedelta,
+                 interval: float, rollup_interval: float, batch_size: int):
+        self.raw_retention = raw_retention
+        self.hourly_retention = hourly_retention
+        self.interval = interval
+        self.rollup_interval = rollup_interval
+        self.batch_size = batch_size
+        # results are only rolled up once they're this old, which leaves time for
+        # transactions that were given lower ids to commit first
+        self.settle_time = timedelta(seconds=5)
+        self._task = None
+
+    async def rollup_results(self):
+        """Rolls up results past the watermark in id order, stopping at the first
+        one that is too recent, so the watermark never skips over a result"""
+        settled = datetime.now() - self.settle_time
+        rolled = 0
+        while True:
+            async with database.OrmSession() as session:
+                watermark = await crud.get_rollup_watermark(session)
+                rows = await crud.get_results_after(session, watermark, self.batch_size)
+                for index, row in enumerate(rows):
+                    if row.timeChecked >= settled:
+                        rows = rows[:index]
+                        break
+                if not rows:
+                    return rolled
+                await save_rollups(session, aggregate(rows))
+                await crud.set_rollup_watermark(session, rows[-1].id)
+                await session.commit()
+            cache.response_cache.invalidate('results')
+            rolled += len(rows)
+            if len(rows) < self.batch_size:
+                return rolled
+            # give the result writer a chance at the database between batches
+            await asyncio.sleep(0)
+
+    async def compact_results(self):
+        cutoff = datetime.now() - self.raw_retention
+        compacted = 0
+        while True:
+            async with database.OrmSession() as session:
+                # only results that are already rolled up may go
+                watermark = await crud.get_rollup_watermark(session)
+                deleted = await crud.delete_expired_results(session, cutoff, watermark,
+                                                            self.batch_size)
+                await session.commit()
+            if deleted:
+                cache.response_cache.invalidate('results')
+            compacted += deleted
+            if deleted < self.batch_size:
+                return compacted
+            await asyncio.sleep(0)
+
+    async def prune_rollups(self):
+        cutoff = datetime.now() - self.hourly_retention
+        pruned = 0
+        while True:
+            async with database.OrmSession() as session:
+                deleted = await crud.delete_expired_rollups(session, 'hour', cutoff,
+                                                            self.batch_size)
+            pruned += deleted
+            if deleted < self.batch_size:
+                return pruned
+            await asyncio.sleep(0)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_compaction = loop.time()
+        while True:
+            try:
+                # with several workers only one of them rolls up and compacts
+                if sharding.shard_coordinator.is_leader():
+                    await self.rollup_results()
+                    # a retention of zero keeps raw results forever
+                    if self.raw_retention and loop.time() >= next_compaction:
+                        next_compaction = loop.time() + self.interval
+                        await self.compact_results()
+                        await self.prune_rollups()
+            except Exception as e:
+                print('Error compacting check results: {}'.format(e))
+            await asyncio.sleep(self.rollup_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name='result-compactor')
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+result_compactor = ResultCompactor(raw_retention=timedelta(hours=settings.raw_retention_hours),
+                                   hourly_retention=timedelta(days=settings.hourly_rollup_retention_days),
+                                   interval=settings.compaction_interval,
+                                   rollup_interval=settings.rollup_interval,
+                                   batch_size=settings.compaction_batch_size)
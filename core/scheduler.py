@@ -0,0 +1,238 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import random
+from . import metrics
+
+"""This module is responsible for deciding when each URL check runs. Instead of
+keeping one sleeping task per check, a single loop keeps every check in a heap
+ordered by next due time and hands due checks to a fixed pool of workers"""
+
+class ScheduledCheck:
+    """Schedule bookkeeping for a single check definition"""
+    __slots__ = ('definition', 'due', 'dispatched_due', 'fail_count', 'running', 
+                 'removed', 'release')
+
+    def __init__(self, definition, due: float):
+        self.definition = definition
+        self.due = due
+        self.dispatched_due = due
+        self.fail_count = 0
+        self.running = False
+        self.removed = False
+        # gives back what admit handed out for the current run, if anything
+        self.release = None
+
+class CheckScheduler:
+    """Dispatches due checks to at most `max_concurrency` workers. Next due times
+    are computed from the previous due time rather than from when the check
+    finished, so the schedule does not drift by the latency of the check itself.
+    Checks are registered by id, one entry each, so adding, updating and removing
+    a check never needs a scan. When given, `admit(entry, resume)` is asked before
+    a due check takes a worker: it returns a function to call once the run is
+    over, or None to hold the check back until it calls `resume(entry, release)`."""
+
+    def __init__(self, job, max_concurrency: int, jitter: float, admit=None):
+        self._job = job
+        self._admit = admit
+        self._max_concurrency = max_concurrency
+        self._jitter = jitter
+        self._heap = []
+        self._entries = {}
+        self._sequence = itertools.count()
+        # heap items left behind by removed or moved entries
+        self._stale = 0
+        # held back checks that admit has let go, ahead of anything on the heap
+        self._resumed = collections.deque()
+        # ids of checks whose due time or failure count changed since the last
+        # take_dirty(), so saving the schedule only writes what moved
+        self._dirty = set()
+        # these are bound to the running loop, so they're created in start()
+        self._wakeup = None
+        self._queue = None
+        # free workers, taken before a check is admitted so that checks waiting
+        # for a worker don't hold on to what admit handed out
+        self._idle = None
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, checkId: int):
+        return checkId in self._entries
+
+    def get(self, checkId: int):
+        return self._entries.get(checkId)
+
+    def check_ids(self):
+        return list(self._entries)
+
+    def _push(self, entry: ScheduledCheck):
+        heapq.heappush(self._heap, (entry.due, next(self._sequence), entry))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _discard(self):
+        # stale items are normally skipped when they reach the top, but a lot of
+        # churn would let them pile up, so past a point the heap is rebuilt
+        self._stale += 1
+        if self._stale > max(len(self._entries), 1024):
+            self._heap = [(x.due, next(self._sequence), x) for x in self._entries.values()]
+            heapq.heapify(self._heap)
+            self._stale = 0
+
+    def add(self, definition, delay: float = None):
+        """Put a check on the schedule. Unless a delay is given, the first run is
+        spread randomly over the jitter window so checks added together don't
+        all fire in the same instant."""
+        self.remove(definition.id)
+        if delay is None:
+            delay = random.uniform(0, min(self._jitter, definition.frequency))
+        now = asyncio.get_event_loop().time()
+        entry = ScheduledCheck(definition, now + delay)
+        self._entries[definition.id] = entry
+        self._dirty.add(definition.id)
+        self._push(entry)
+        return entry
+
+    def remove(self, checkId: int):
+        # heap entries are removed lazily when they reach the top of the heap
+        entry = self._entries.pop(checkId, None)
+        if entry is not None:
+            entry.removed = True
+            self._discard()
+        return entry
+
+    def update(self, definition):
+        """Swaps in a new definition for a scheduled check without losing its place
+        or its failure count. A run already in progress finishes with the old
+        definition. A shorter frequency takes effect from now, a longer one after
+        the run that's already planned. Unscheduled checks are added."""
+        entry = self._entries.get(definition.id)
+        if entry is None:
+            return self.add(definition)
+        previous, entry.definition = entry.definition, definition
+        if definition.frequency < previous.frequency:
+            now = asyncio.get_event_loop().time()
+            due = min(entry.due, now + definition.frequency)
+            if due != entry.due:
+                entry.due = due
+                self._dirty.add(definition.id)
+                self._discard()
+                self._push(entry)
+        return entry
+
+    def take_dirty(self) -> list:
+        """Returns the entries that changed since the last call"""
+        dirty = [self._entries[x] for x in self._dirty if x in self._entries]
+        self._dirty = set()
+        return dirty
+
+    def mark_dirty(self, checkId: int):
+        self._dirty.add(checkId)
+
+    def _reschedule(self, entry: ScheduledCheck, now: float):
+        frequency = max(entry.definition.frequency, 1)
+        due = entry.due + frequency
+        if due <= now:
+            # we fell behind by whole intervals, skip them instead of bursting
+            missed = int((now - entry.due) // frequency)
+            due = entry.due + (missed + 1) * frequency
+        entry.due = due
+        self._dirty.add(entry.definition.id)
+        self._push(entry)
+
+    def _resume(self, entry: ScheduledCheck, release):
+        entry.release = release
+        self._resumed.append(entry)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _finish(self, entry: ScheduledCheck):
+        if entry.release is not None:
+            entry.release()
+            entry.release = None
+        entry.running = False
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            if self._resumed:
+                entry = self._resumed.popleft()
+                if entry.removed:
+                    self._finish(entry)
+                else:
+                    await self._idle.acquire()
+                    self._queue.put_nowait(entry)
+                continue
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            due, _, entry = self._heap[0]
+            delay = due - loop.time()
+            if delay > 0:
+                # wait_for can swallow a cancellation that lands just as the event
+                # is set, which would leave this loop running after stop()
+                timer = loop.call_later(delay, self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    timer.cancel()
+                continue
+            heapq.heappop(self._heap)
+            if entry.removed or due != entry.due:
+                self._stale = max(self._stale - 1, 0)
+                continue
+            self._reschedule(entry, loop.time())
+            if entry.running:
+                # the previous run of this check is still going, skip this slot
+                continue
+            entry.running = True
+            entry.dispatched_due = due
+            # this waits whenever every worker is busy
+            await self._idle.acquire()
+            if self._admit is not None:
+                entry.release = self._admit(entry, self._resume)
+                if entry.release is None:
+                    # held back without a worker until it's resumed
+                    self._idle.release()
+                    continue
+            self._queue.put_nowait(entry)
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self._queue.get()
+            metrics.checks_in_flight.inc()
+            try:
+                if not entry.removed:
+                    metrics.schedule_lag.observe(max(loop.time() - entry.dispatched_due, 0))
+                    await self._job(entry)
+            except Exception as e:
+                # a failing check must never take a worker down with it
+                metrics.check_errors.inc()
+                print('Error running check {}: {}'.format(entry.definition.id, e))
+            finally:
+                metrics.checks_in_flight.dec()
+                self._finish(entry)
+                self._idle.release()
+                # the failure count may have changed
+                self._dirty.add(entry.definition.id)
+                self._queue.task_done()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._queue = asyncio.Queue(maxsize=self._max_concurrency)
+        self._idle = asyncio.Semaphore(self._max_concurrency)
+        self._tasks = [asyncio.create_task(self._dispatch(), name='scheduler')]
+        for i in range(self._max_concurrency):
+            self._tasks.append(asyncio.create_task(self._work(),
+                                                   name='scheduler-worker-{}'.format(i)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
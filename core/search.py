@@ -0,0 +1,113 @@
+from sqlalchemy import Table, Column, Integer, String, MetaData, literal_column, select, text
+from . import models
+
+"""This module is responsible for searching check definitions by url. On SQLite
+every url is copied into an FTS5 table using the trigram tokenizer, along with its
+host and path, so a substring search is an index lookup instead of a scan of every
+definition. Triggers on the definitions table keep the copy in sync with every
+write, whichever code path makes it. Terms shorter than a trigram, and databases
+without FTS5, fall back to LIKE"""
+
+# a virtual table can't be created from metadata, so this is only for queries and
+# the migration below creates it
+search_metadata = MetaData()
+url_search = Table('definitions_search', search_metadata,
+                   Column('rowid', Integer, primary_key=True),
+                   Column('url', String),
+                   Column('host', String),
+                   Column('path', String))
+
+def _host_and_path(url: str):
+    """SQL expressions for the host (with any port) and the path (without the
+    query or fragment) of the url in the SQL expression `url`"""
+    rest = "substr({0}, instr({0}, '://') + 3)".format(url)
+    end = "min(instr({0} || '/', '/'), instr({0} || '?', '?'), instr({0} || '#', '#'))".format(rest)
+    host = 'substr({}, 1, {} - 1)'.format(rest, end)
+    after = 'substr({}, {})'.format(rest, end)
+    path = "substr({0}, 1, min(instr({0} || '?', '?'), instr({0} || '#', '#')) - 1)".format(after)
+    return host, path
+
+def _insert_sql(row: str, url: str, source: str = '') -> str:
+    host, path = _host_and_path(url)
+    return ('INSERT INTO definitions_search (rowid, url, host, path) '
+            'SELECT {}, {}, {}, {}{}'.format(row, url, host, path, source))
+
+SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS definitions_search USING fts5("
+    "url, host, path, tokenize='trigram')",
+    'CREATE TRIGGER IF NOT EXISTS definitions_search_insert AFTER INSERT ON definitions '
+    'BEGIN {}; END'.format(_insert_sql('new.id', 'new.url')),
+    'CREATE TRIGGER IF NOT EXISTS definitions_search_delete AFTER DELETE ON definitions '
+    'BEGIN DELETE FROM definitions_search WHERE rowid = old.id; END',
+    'CREATE TRIGGER IF NOT EXISTS definitions_search_update AFTER UPDATE OF id, url ON definitions '
+    'BEGIN DELETE FROM definitions_search WHERE rowid = old.id; {}; END'.format(
+        _insert_sql('new.id', 'new.url')),
+    # definitions written before the triggers existed
+    _insert_sql('id', 'url', ' FROM definitions WHERE id NOT IN '
+                '(SELECT rowid FROM definitions_search)')
+]
+
+class UrlIndex:
+    """Builds the filters for url searches, using the search table when the
+    database has it. `enabled` is set by `detect` once the schema is up to date."""
+
+    def __init__(self):
+        self.enabled = False
+
+    def supported(self, connection) -> bool:
+        # the trigram tokenizer arrived in SQLite 3.34
+        if connection.dialect.name != 'sqlite':
+            return False
+        version = connection.execute(text('SELECT sqlite_version()')).scalar()
+        if tuple(int(x) for x in version.split('.')) < (3, 34, 0):
+            return False
+        return bool(connection.execute(text(
+            "SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar())
+
+    def create(self, connection):
+        """Creates the search table and its triggers, and fills it. Meant to be run
+        as a migration, and does nothing where it isn't supported."""
+        if not self.supported(connection):
+            print('URL search index not supported by this database, searches will scan')
+            return
+        for statement in SCHEMA:
+            connection.execute(text(statement))
+
+    def drop(self, connection):
+        # the triggers go with the definitions table
+        if connection.dialect.name == 'sqlite':
+            connection.execute(text('DROP TABLE IF EXISTS definitions_search'))
+
+    def detect(self, connection):
+        self.enabled = self.supported(connection) and bool(connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'definitions_search'")).scalar())
+
+    def filters(self, **terms) -> list:
+        """Filters on check definitions for urls containing every given term, case
+        insensitively, in the facet (url, host or path) it's given for"""
+        terms = {facet: term for facet, term in terms.items() if term}
+        if not self.enabled:
+            # without the host and path columns, those terms match the whole url
+            return [models.CheckDefinition.url.contains(term) for term in terms.values()]
+        filters, phrases = [], []
+        for facet, term in terms.items():
+            if len(term) >= 3:
+                # a column filter, with the term quoted as one FTS5 string
+                phrases.append('{} : "{}"'.format(facet, term.replace('"', '""')))
+            elif facet == 'url':
+                # too short for a trigram, so it's a scan, and the definitions
+                # table is quicker to scan than the search table
+                filters.append(models.CheckDefinition.url.contains(term))
+            else:
+                # SQLite 3.40 crashes on a short LIKE and a MATCH against a trigram
+                # table in the same query, so each of these is a query of its own
+                filters.append(self._matching(url_search.c[facet].contains(term)))
+        if phrases:
+            filters.append(self._matching(literal_column(url_search.name).op('MATCH')(
+                ' AND '.join(phrases))))
+        return filters
+
+    def _matching(self, condition):
+        return models.CheckDefinition.id.in_(select(url_search.c.rowid).where(condition))
+
+url_index = UrlIndex()
@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+import os
+import socket
+from datetime import datetime, timedelta
+from . import database, crud, validations
+
+"""This module is responsible for splitting checks between worker processes. Each
+worker renews a lease row in the database, and every live worker independently
+computes the same owner for each check by rendezvous hashing over the live set,
+so no check runs in two workers and only a dead worker's checks move"""
+
+# get environment variables
+settings = validations.EnvironmentSettings()
+
+def _weight(workerId: str, checkId: int) -> int:
+    # python's own hash() is salted per process, so it can't be used here
+    digest = hashlib.blake2b('{}:{}'.format(workerId, checkId).encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), 'big')
+
+class ShardCoordinator:
+    """Tracks the live workers and decides which checks belong to this one. When
+    disabled every check belongs to this worker."""
+
+    def __init__(self, enabled: bool, heartbeat_interval: float, lease_ttl: float):
+        self.enabled = enabled
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_ttl = timedelta(seconds=lease_ttl)
+        self.worker_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.workers = [self.worker_id]
+        self._task = None
+
+    def owns(self, checkId: int) -> bool:
+        if not self.enabled or len(self.workers) == 1:
+            return True
+        return max(self.workers, key=lambda workerId: _weight(workerId, checkId)) == self.worker_id
+
+    def is_leader(self) -> bool:
+        """One worker is picked for housekeeping that must only run once"""
+        return not self.enabled or self.workers[0] == self.worker_id
+
+    async def heartbeat(self) -> bool:
+        """Renews this worker's lease and returns whether the live set changed"""
+        now = datetime.utcnow()
+        async with database.OrmSession() as session:
+            await crud.renew_worker_lease(session, self.worker_id, now)
+            # leases long past expiry are only kept around for debugging
+            await crud.delete_worker_leases(session, before=now - self.lease_ttl * 10)
+            workers = await crud.get_live_workers(session, now - self.lease_ttl)
+        changed = workers != self.workers
+        self.workers = workers
+        return changed
+
+    async def _run(self, rebalance):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                # definitions changed through other workers are picked up by the
+                # periodic reconcile, this only reacts to workers coming and going
+                if await self.heartbeat():
+                    await rebalance()
+            except Exception as e:
+                print('Error renewing worker lease: {}'.format(e))
+
+    async def join(self):
+        if self.enabled:
+            await self.heartbeat()
+
+    def start(self, rebalance):
+        """Starts heartbeating, calling `rebalance` whenever ownership may have moved"""
+        if self.enabled:
+            self._task = asyncio.create_task(self._run(rebalance), name='shard-coordinator')
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # dropping the lease lets the other workers take over right away
+        async with database.OrmSession() as session:
+            await crud.delete_worker_leases(session, workerId=self.worker_id)
+
+shard_coordinator = ShardCoordinator(enabled=settings.sharding_enabled,
+                                     heartbeat_interval=settings.shard_heartbeat_interval,
+                                     lease_ttl=settings.shard_lease_ttl)
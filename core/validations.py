@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel, BaseSettings, HttpUrl
 
@@ -20,6 +20,79 @@ class EnvironmentSettings(BaseSettings):
     smtp_password: str
     smtp_use_tls: bool = True
 
+    # alert dispatcher config
+    smtp_pool_size: int = 2
+    smtp_idle_timeout: float = 60 # seconds
+    alert_cooldown: float = 300 # seconds between alerts for the same check
+    alert_queue_size: int = 1000
+    alert_max_retries: int = 3
+    alert_retry_delay: float = 30 # seconds, doubled after each failed attempt
+
+    # scheduler config
+    max_concurrent_checks: int = 100
+    schedule_jitter: float = 5.0 # seconds
+    reconcile_interval: float = 30 # seconds between resyncing the schedule with the database, 0 never does
+    schedule_checkpoint_interval: float = 15 # seconds between saving next due times and failure counts
+    startup_page_size: int = 1000 # definitions loaded per query at startup
+    startup_catchup_window: float = 60 # seconds to spread overdue checks over after a restart or shard takeover
+
+    # sharding config, enable when running more than one worker process
+    sharding_enabled: bool = False
+    shard_heartbeat_interval: float = 5 # seconds
+    shard_lease_ttl: float = 15 # seconds
+
+    # outbound http client config
+    http_max_connections: int = 1000
+    http_max_keepalive_connections: int = 200
+    http_keepalive_expiry: float = 30.0 # seconds
+    http_per_host_connections: int = 10
+    http_per_host_interval: float = 0 # minimum seconds between request starts to one host
+    check_timeout: float = 30 # seconds, for checks without their own timeoutMs
+    circuit_breaker_threshold: int = 5 # consecutive failed requests that open a host's circuit, 0 never opens
+    circuit_breaker_reset_timeout: float = 30 # seconds between probes of a host with an open circuit
+    http_use_http2: bool = False
+
+    # response body config
+    max_body_bytes: int = 1048576 # stop searching for expectedString after this much
+    status_only_use_head: bool = False # send HEAD for checks without an expectedString
+    content_cache_size: int = 10000 # content checks whose last response is remembered
+
+    # database config, the sqlite settings only apply to sqlite urls
+    database_url: str = 'sqlite+aiosqlite:///./urlchecker.db'
+    database_echo: bool = False # log every SQL statement
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    sqlite_journal_mode: str = 'WAL'
+    sqlite_synchronous: str = 'NORMAL'
+    sqlite_busy_timeout: int = 5000 # milliseconds to wait for a lock
+    sqlite_cache_size_kb: int = 20000
+
+    # result writer config
+    result_batch_size: int = 500
+    result_flush_interval: float = 1.0 # seconds
+    result_buffer_size: int = 10000
+    result_max_retries: int = 5 # failed attempts at writing a batch before it's dropped
+
+    # largest page any list endpoint will return
+    max_page_size: int = 1000
+    response_cache_bytes: int = 52428800 # encoded read responses kept in memory
+    response_cache_ttl: float = 5 # seconds a cached response may miss other workers' writes, 0 disables the cache
+
+    # live result streams, each subscriber buffers up to live_buffer_size events
+    live_buffer_size: int = 100
+    live_max_subscribers: int = 1000
+    live_keepalive_interval: float = 15 # seconds
+
+    # definitions written per transaction by the bulk import endpoint
+    import_batch_size: int = 500
+
+    # result retention config, set raw_retention_hours to 0 to keep raw results forever
+    raw_retention_hours: int = 168
+    hourly_rollup_retention_days: int = 90
+    compaction_interval: float = 3600 # seconds
+    rollup_interval: float = 60 # seconds between rolling up new results
+    compaction_batch_size: int = 5000
+
     # set this to true to drop all data from the db
     drop_all: bool = False
 
@@ -34,6 +107,15 @@ class EnvironmentSettings(BaseSettings):
     class Config:
         env_file = '.env'
 
+class PageParams(BaseModel):
+    """Sorting and pagination for list endpoints. `after` is the id of the last
+    row of the previous page and switches to keyset pagination when given."""
+    offset: int = 0
+    limit: int
+    sort: str = 'id'
+    descending: bool = False
+    after: Optional[int] = None
+
 class NotificationAddressBase(BaseModel):
     checkId: int
     emailAddress: str
@@ -52,6 +134,8 @@ class CheckBase(BaseModel):
     frequency: int
     expectedStatus: int
     expectedString: Optional[str] = None
+    maxLatencyMs: Optional[int] = None
+    timeoutMs: Optional[int] = None
 
 class Check(CheckBase):
     id: int
@@ -64,6 +148,7 @@ class LatestResult(CheckBase):
     id: int
     lastChecked: datetime
     lastState: str
+    lastLatencyMs: Optional[int] = None
 
     class Config:
         orm_mode = True
@@ -73,6 +158,9 @@ class CheckResultBase(BaseModel):
     timeChecked: datetime
     statusCode: int
     state: str
+    latencyMs: Optional[int] = None
+    ttfbMs: Optional[int] = None
+    bytesReceived: Optional[int] = None
 
 class CheckResult(CheckResultBase):
     id: int
@@ -81,8 +169,39 @@ class CheckResult(CheckResultBase):
     class Config:
         orm_mode = True
 
+class ImportLineError(BaseModel):
+    line: int
+    error: str
+
+class ImportSummary(BaseModel):
+    created: int = 0
+    updated: int = 0
+    failed: int = 0
+    # only the first errors are listed, 'failed' has the full count
+    errors: List[ImportLineError] = []
+
+class UptimeStats(BaseModel):
+    start: datetime
+    end: datetime
+    count: int = 0
+    failures: int = 0
+    uptimePercent: Optional[float] = None
+    statusCodes: Dict[str, int] = {}
+    latencyMeanMs: Optional[float] = None
+    latencyMinMs: Optional[int] = None
+    latencyMaxMs: Optional[int] = None
+    # percentiles are read from latency histograms, so within about 10%
+    latencyP50Ms: Optional[int] = None
+    latencyP95Ms: Optional[int] = None
+    latencyP99Ms: Optional[int] = None
+
+class CheckAnalytics(UptimeStats):
+    checkId: int
+    buckets: List[UptimeStats] = []
+
 class CheckWithResults(Check):
-    results = str 
+    # the most recent results, newest first
+    results: List[CheckResultBase] = []
 
     class Config:
         orm_mode = True
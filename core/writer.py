@@ -0,0 +1,125 @@
+import asyncio
+from sqlalchemy.exc import IntegrityError
+from . import database, crud, validations, metrics
+
+"""This module is responsible for persisting check results. Results are buffered
+in memory and written in bulk, so the database sees one transaction per batch
+instead of one per check"""
+
+# get environment variables
+settings = validations.EnvironmentSettings()
+
+class ResultWriter:
+    """Collects check results and flushes them once `batch_size` results are
+    waiting or `flush_interval` seconds have passed since the first one arrived.
+    The buffer is bounded, so producers wait when the database can't keep up.
+    A batch that still fails after `max_retries` attempts is dropped, so one bad
+    batch can't stall the writer and every check waiting to queue a result."""
+
+    def __init__(self, batch_size: int, flush_interval: float, buffer_size: int,
+                 max_retries: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.max_retries = max_retries
+        # the queue is bound to the running loop, so it's created in start()
+        self._queue = None
+        self._task = None
+        self._stopping = False
+
+    async def put(self, check_result: validations.CheckResultBase):
+        await self._queue.put(check_result)
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _collect(self, batch: list):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                return False
+            batch.append(item)
+        return True
+
+    async def _without_deleted_checks(self, batch: list) -> list:
+        async with database.OrmSession() as session:
+            existing = await crud.get_existing_check_ids(
+                session, list({x.checkId for x in batch}))
+        kept = [x for x in batch if x.checkId in existing]
+        if len(kept) < len(batch):
+            metrics.results_dropped.inc(len(batch) - len(kept), reason='check_deleted')
+        return kept
+
+    async def _flush(self, batch: list):
+        failures = 0
+        while batch:
+            try:
+                with metrics.db_write_duration.time():
+                    async with database.OrmSession() as session:
+                        await crud.save_check_results(session, batch)
+                metrics.results_written.inc(len(batch))
+                return
+            except Exception as e:
+                print('Error saving {} check results: {}'.format(len(batch), e))
+                error = e
+            if isinstance(error, IntegrityError):
+                # results of checks deleted while they ran or sat in the buffer fail
+                # the foreign key, and would fail it again on every retry
+                try:
+                    kept = await self._without_deleted_checks(batch)
+                except Exception as e:
+                    print('Error looking up the checks of unsaved results: {}'.format(e))
+                else:
+                    if len(kept) < len(batch):
+                        batch = kept
+                        continue
+            failures += 1
+            # once stopping nothing waits on the retries, so a batch gets fewer
+            limit = min(self.max_retries, 2) if self._stopping else self.max_retries
+            if failures >= limit:
+                print('Dropping {} check results after {} failed attempts'.format(
+                    len(batch), failures))
+                metrics.results_dropped.inc(len(batch), reason='write_failed')
+                return
+            await asyncio.sleep(self.flush_interval)
+
+    async def _run(self):
+        running = True
+        while running:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            running = await self._collect(batch)
+            await self._flush(batch)
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.buffer_size)
+        self._task = asyncio.create_task(self._run(), name='result-writer')
+
+    async def stop(self):
+        """Flushes everything still buffered before returning, giving up on
+        batches that fail to save twice"""
+        if self._task is None:
+            return
+        self._stopping = True
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        self._stopping = False
+
+result_writer = ResultWriter(batch_size=settings.result_batch_size,
+                             flush_interval=settings.result_flush_interval,
+                             buffer_size=settings.result_buffer_size,
+                             max_retries=settings.result_max_retries)
@@ -1,11 +1,12 @@
+from datetime import datetime, timedelta
 from typing import Optional, List
-from fastapi import FastAPI, Depends, Response, status
+import asyncio
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, Query, status
 from fastapi.staticfiles import StaticFiles
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, PlainTextResponse, StreamingResponse, JSONResponse
 import uvicorn
-import asyncio
 
-from core import database, validations, crud, security, jobs
+from core import database, validations, crud, security, jobs, clients, writer, retention, notifications, cache, sharding, metrics, bulk, migrations, broadcast, analytics, checkpoint, responses, search
 
 # grab environment variables and store them in a dictionary
 settings = validations.EnvironmentSettings()
@@ -19,26 +20,86 @@ app.mount("/ui", StaticFiles(directory=settings.build_directory, html=True),
 app.mount("/static", StaticFiles(directory= settings.build_directory + "/static"), 
           name="static")
 
+app.add_middleware(metrics.RequestMetricsMiddleware)
+
 async def get_orm_session() -> database.AsyncSession:
     async with database.OrmSession() as session:
         yield session
 
+async def get_page_params(start: int = Query(0, alias='_start'), 
+                          end: Optional[int] = Query(None, alias='_end'),
+                          sort: str = Query('id', alias='_sort'), 
+                          order: str = Query('ASC', alias='_order'),
+                          after: Optional[int] = None) -> validations.PageParams:
+    # these aliases match the query parameters react-admin's json-server provider sends
+    limit = settings.max_page_size
+    if end is not None:
+        limit = min(max(end - start, 0), limit)
+    return validations.PageParams(offset=start, limit=limit, sort=sort, 
+                                  descending=order.upper() == 'DESC', after=after)
+
+def page_headers(total: int, rows: list, page: validations.PageParams) -> dict:
+    # the 'X-Total-Count' header is what lets react-admin paginate
+    headers = {'X-Total-Count': str(total)}
+    if rows and len(rows) == page.limit:
+        # clients that prefer keyset pagination pass this back as 'after'
+        headers['X-Next-Cursor'] = str(rows[-1].id)
+    return headers
+
+def as_stored(moment: Optional[datetime]) -> Optional[datetime]:
+    # timestamps are stored as naive local times, so aware ones are converted to that
+    if moment is None or moment.tzinfo is None:
+        return moment
+    return moment.astimezone().replace(tzinfo=None)
+
+@app.exception_handler(crud.UnknownCursor)
+async def unknown_cursor(request: Request, exc: crud.UnknownCursor):
+    # the row may have been deleted since, so the client has to start over
+    return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, 
+                        content={'detail': "'after' names a row that isn't in the results"})
+
 @app.on_event('startup')
 async def initialize_data_and_jobs():
     async with database.engine.begin() as conn:
-        # these queries are responsible for ensuring the necessary tables exist
+        # these queries are responsible for ensuring the schema is up to date
         if settings.drop_all:
-            await conn.run_sync(database.Base.metadata.drop_all)
-        await conn.run_sync(database.Base.metadata.create_all)
+            await conn.run_sync(migrations.drop_schema)
+        await conn.run_sync(migrations.run_migrations)
+        await conn.run_sync(search.url_index.detect)
     async with database.OrmSession() as session:
-        async with session.begin():
-            # sqlite doesn't have foreign keys turned on by default apparently
-            await session.execute('PRAGMA foreign_keys=ON;')
-            # start all of the existing URL checks defined in the database
-            definitions = await crud.get_check_defintions(session=session)
-            for db_check_definition in definitions:
-                asyncio.create_task(jobs.url_check_job(db_check_definition), 
-                                    name=db_check_definition.id)
+        # databases created before latest_results existed need it filled once
+        if not await crud.has_latest_results(session):
+            await crud.rebuild_latest_results(session)
+    await sharding.shard_coordinator.join()
+    writer.result_writer.start()
+    notifications.alert_dispatcher.start()
+    jobs.check_scheduler.start()
+    # the checks this worker owns are loaded in the background, a page at a time,
+    # and resume their saved schedule, so startup doesn't wait on them
+    app.state.check_loader = asyncio.create_task(
+        jobs.load_checks(settings.startup_page_size, settings.startup_catchup_window), 
+        name='check-loader')
+    jobs.check_reconciler.start()
+    checkpoint.schedule_checkpointer.start()
+    retention.result_compactor.start()
+    sharding.shard_coordinator.start(jobs.resync_checks)
+    app.state.loop_monitor = asyncio.create_task(metrics.monitor_event_loop(), 
+                                                 name='loop-monitor')
+
+@app.on_event('shutdown')
+async def stop_jobs():
+    app.state.loop_monitor.cancel()
+    app.state.check_loader.cancel()
+    await sharding.shard_coordinator.stop()
+    await jobs.check_reconciler.stop()
+    await retention.result_compactor.stop()
+    await jobs.check_scheduler.stop()
+    # saved only once no check can move any more
+    await checkpoint.schedule_checkpointer.stop()
+    # flush any buffered results only once no more checks can produce them
+    await writer.result_writer.stop()
+    await notifications.alert_dispatcher.stop()
+    await clients.client_manager.aclose()
 
 # since we can't mount static files on "/", redirect requests from root to "/ui"
 @app.get('/')
@@ -46,42 +107,104 @@ async def redirect_for_ui(auth = Depends(security.has_auth)):
     response = RedirectResponse(url='/ui')
     return response
 
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics(auth = Depends(security.has_auth)):
+    # Prometheus text exposition format
+    return PlainTextResponse(metrics.render(), 
+                             media_type='text/plain; version=0.0.4')
+
+# read endpoints answer through responses.cached, which encodes rows straight to
+# JSON and caches the result, so response_model only documents their output
 @app.get('/latestresults', response_model=List[validations.LatestResult])
-async def get_latest_results(response: Response, urlcontains: Optional[str] = None, 
+async def get_latest_results(request: Request, urlcontains: Optional[str] = None, 
+                             hostcontains: Optional[str] = None, 
+                             pathcontains: Optional[str] = None,
+                             lastState: Optional[str] = None,
+                             id: Optional[List[int]] = Query(None),
+                             page: validations.PageParams = Depends(get_page_params),
                              orm_session: database.AsyncSession = Depends(get_orm_session), 
                              auth = Depends(security.has_auth)):
-    db_latest_checks = await crud.get_latest_results(orm_session, urlcontains)
-    # the 'X-Total-Count' header works to allow pagination to occur. 
-    # This isn't really implemented correctly, but works fine for small datasets 
-    response.headers['X-Total-Count'] = str(len(db_latest_checks))
-    return db_latest_checks
+    async def build():
+        db_latest_checks = await crud.get_latest_results(orm_session, urlcontains, 
+                                                         lastState, id, page, 
+                                                         hostcontains, pathcontains)
+        total = await crud.count_latest_results(orm_session, urlcontains, lastState, id, 
+                                                hostcontains, pathcontains)
+        return (status.HTTP_200_OK, 
+                [responses.to_dict(x, responses.LATEST_RESULT_FIELDS) for x in db_latest_checks],
+                page_headers(total, db_latest_checks, page))
+    return await responses.cached(request, ('definitions', 'results'), build)
 
 @app.get('/checkdefinitions', response_model=List[validations.Check])
-async def get_url_checks(response: Response, urlcontains: Optional[str] = None, 
+async def get_url_checks(request: Request, urlcontains: Optional[str] = None, 
+                         hostcontains: Optional[str] = None, 
+                         pathcontains: Optional[str] = None,
+                         id: Optional[List[int]] = Query(None), expand: bool = True,
+                         page: validations.PageParams = Depends(get_page_params),
                          orm_session: database.AsyncSession = Depends(get_orm_session), 
                          auth = Depends(security.has_auth)):
-    db_check_definitions = await crud.get_check_defintions(orm_session, urlcontains)
-    response.headers['X-Total-Count'] = str(len(db_check_definitions))
-    return db_check_definitions
+    async def build():
+        db_check_definitions = await crud.get_check_defintions(orm_session, urlcontains, 
+                                                               id, page, hostcontains, 
+                                                               pathcontains)
+        addresses = []
+        if expand:
+            addresses = await crud.get_addresses_for_checks(
+                orm_session, [x.id for x in db_check_definitions])
+        total = await crud.count_check_definitions(orm_session, urlcontains, id, 
+                                                   hostcontains, pathcontains)
+        return (status.HTTP_200_OK, 
+                responses.definition_dicts(db_check_definitions, addresses),
+                page_headers(total, db_check_definitions, page))
+    return await responses.cached(request, ('definitions', 'addresses'), build)
 
 @app.post('/checkdefinitions', status_code=status.HTTP_201_CREATED)
 async def create_url_check(check_definition: validations.CheckBase, 
                            orm_session: database.AsyncSession = Depends(get_orm_session),
                            auth = Depends(security.has_auth)):
     db_check_definition = await crud.create_check_defintion(orm_session, check_definition)
-    asyncio.create_task(jobs.url_check_job(db_check_definition), name=db_check_definition.id)
+    jobs.schedule_check(cache.definition_cache.get_definition(db_check_definition.id))
     return db_check_definition
 
+# these two are declared before '/checkdefinitions/{checkId}' so they aren't taken for an id
+@app.post('/checkdefinitions/import', response_model=validations.ImportSummary)
+async def import_url_checks(request: Request, 
+                            format: Optional[str] = Query(None, regex='^(ndjson|csv)$'),
+                            orm_session: database.AsyncSession = Depends(get_orm_session),
+                            auth = Depends(security.has_auth)):
+    # without an explicit format, go by the content type and default to NDJSON
+    if format is None:
+        format = 'csv' if 'csv' in request.headers.get('content-type', '') else 'ndjson'
+    return await bulk.import_definitions(orm_session, request.stream(), format, 
+                                         settings.import_batch_size)
+
+@app.get('/checkdefinitions/export')
+async def export_url_checks(format: str = Query('ndjson', regex='^(ndjson|csv)$'), 
+                            urlcontains: Optional[str] = None, 
+                            id: Optional[List[int]] = Query(None),
+                            auth = Depends(security.has_auth)):
+    return StreamingResponse(bulk.export_definitions(format, urlcontains, id), 
+                             media_type=bulk.FORMATS[format])
+
 @app.get('/checkdefinitions/{checkId}', response_model=validations.CheckWithResults)
-async def get_url_check_info(checkId: int, response: Response, 
+async def get_url_check_info(checkId: int, request: Request, 
+                             results: int = Query(20, ge=0),
                              orm_session: database.AsyncSession = Depends(get_orm_session),
                              auth = Depends(security.has_auth)):
-    db_check_definition = await crud.get_check_definition_by_id(orm_session, checkId)
-    db_check_definition
-    if not db_check_definition:
-        response.status_code = status.HTTP_404_NOT_FOUND
-        return
-    return db_check_definition
+    async def build():
+        db_check_definition = await crud.get_check_definition_by_id(orm_session, checkId)
+        if not db_check_definition:
+            return status.HTTP_404_NOT_FOUND, None, {}
+        addresses = await crud.get_addresses_for_checks(orm_session, [checkId])
+        # only the most recent results, the full history is what /checkresults is for
+        page = validations.PageParams(limit=min(results, settings.max_page_size), 
+                                      sort='timeChecked', descending=True)
+        db_results = await crud.get_check_results(orm_session, checkId, page=page)
+        check = responses.definition_dicts([db_check_definition], addresses)[0]
+        return (status.HTTP_200_OK, 
+                dict(check, results=[responses.to_dict(x, responses.RESULT_BASE_FIELDS) 
+                                    for x in db_results]), {})
+    return await responses.cached(request, responses.result_topics([checkId]), build)
 
 @app.put('/checkdefinitions/{checkId}', status_code=status.HTTP_201_CREATED)
 async def update_url_check(checkId: int, check_definition: validations.CheckBase, 
@@ -90,11 +213,10 @@ async def update_url_check(checkId: int, check_definition: validations.CheckBase
                            auth = Depends(security.has_auth)):
     rows_affected = await crud.update_check_definition_by_id(orm_session, checkId, check_definition)
     if rows_affected == 1:
-        # if a job definition was actually uupdated, we should kill the old task...
-        await jobs.cancel_task_by_name(str(checkId))
-        db_check_definition = validations.Check(id=checkId, **check_definition.dict())
-        # ... and spin up a new task with the updated definition
-        asyncio.create_task(jobs.url_check_job(db_check_definition), name=checkId)
+        # if a job definition was actually updated, the scheduled check picks up the
+        # new values in place, keeping its next run time and failure count
+        db_check_definition = cache.definition_cache.get_definition(checkId)
+        jobs.schedule_check(db_check_definition)
         return db_check_definition
     else:
         response.status_code = status.HTTP_404_NOT_FOUND
@@ -105,35 +227,119 @@ async def delete_url_check(checkId: int,
                            auth = Depends(security.has_auth)):
     rows_affected = await crud.delete_check_definition_by_id(orm_session, checkId)
     if rows_affected == 1:
-        # if a job definition was actually deleted, we should kill the active task
-        await jobs.cancel_task_by_name(str(checkId))
+        # if a job definition was actually deleted, take it off the schedule
+        jobs.check_scheduler.remove(checkId)
+        broadcast.result_broadcaster.forget(checkId)
         # some APIs return the deleted record, some just return 204 No Content.
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     else:
         return Response(status_code=status.HTTP_404_NOT_FOUND)
 
+@app.get('/checkresults/stream')
+async def stream_check_results(checkId: Optional[List[int]] = Query(None), 
+                               state: Optional[List[str]] = Query(None),
+                               changes: bool = False,
+                               auth = Depends(security.has_auth)):
+    # server-sent events, so browsers can subscribe with EventSource, which can't
+    # set headers, so pass the api key as a query parameter or cookie
+    subscription = broadcast.result_broadcaster.subscribe(checkId, state, changes)
+    if subscription is None:
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    events = broadcast.result_broadcaster.events(subscription, 
+                                                 settings.live_keepalive_interval)
+    return StreamingResponse(events, media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 
+                                      'X-Accel-Buffering': 'no'})
+
 @app.get('/checkresults', response_model=List[validations.CheckResult])
-async def get_check_results(response: Response, 
+async def get_check_results(request: Request, checkId: Optional[int] = None, 
+                            state: Optional[str] = None, since: Optional[datetime] = None,
+                            until: Optional[datetime] = None, 
+                            id: Optional[List[int]] = Query(None), expand: bool = True,
+                            page: validations.PageParams = Depends(get_page_params),
                             orm_session: database.AsyncSession = Depends(get_orm_session),
                             auth = Depends(security.has_auth)):
-    results = await crud.get_check_results(orm_session)
-    response.headers['X-Total-Count'] = str(len(results))
-    return results
+    async def build():
+        results = await crud.get_check_results(orm_session, checkId, state, as_stored(since), 
+                                               as_stored(until), id, page)
+        definitions = {}
+        if expand:
+            # each check on the page is loaded and encoded once, however many results it has
+            checkIds = list({x.checkId for x in results})
+            db_check_definitions = await crud.get_check_defintions(orm_session, ids=checkIds)
+            addresses = await crud.get_addresses_for_checks(orm_session, checkIds)
+            definitions = {x['id']: x for x in responses.definition_dicts(db_check_definitions, 
+                                                                          addresses)}
+        total = await crud.count_check_results(orm_session, checkId, state, as_stored(since), 
+                                               as_stored(until), id)
+        return (status.HTTP_200_OK, responses.result_dicts(results, definitions),
+                page_headers(total, results, page))
+    topics = (responses.result_topics([checkId]) if checkId 
+              else ('definitions', 'addresses', 'results'))
+    return await responses.cached(request, topics, build)
+
+@app.get('/analytics', response_model=List[validations.CheckAnalytics])
+async def get_analytics(request: Request, checkId: Optional[List[int]] = Query(None), 
+                        since: Optional[datetime] = None, until: Optional[datetime] = None,
+                        bucket: Optional[int] = Query(None, ge=1),
+                        page: validations.PageParams = Depends(get_page_params),
+                        orm_session: database.AsyncSession = Depends(get_orm_session),
+                        auth = Depends(security.has_auth)):
+    # the window defaults to the last day, 'bucket' is in seconds
+    until = as_stored(until) or datetime.now()
+    since = as_stored(since) or until - timedelta(days=1)
+    if since >= until:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail="'since' must be before 'until'")
+    bucket_count = analytics.bucket_total(since, until, bucket)
+    if bucket_count > settings.max_page_size:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail='at most {} buckets per report'.format(settings.max_page_size))
+    if checkId and len(checkId) > settings.max_page_size:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail='at most {} checks per request'.format(settings.max_page_size))
+    async def build():
+        if checkId:
+            checkIds, headers = checkId, {}
+        else:
+            # without 'checkId' the reports are paged over every check, with fewer
+            # checks to a page the more buckets each report has
+            limit = max(settings.max_page_size // max(bucket_count, 1), 1)
+            check_page = page.copy(update={'limit': min(page.limit, limit)})
+            definitions = await crud.get_check_defintions(orm_session, page=check_page)
+            total = await crud.count_check_definitions(orm_session)
+            checkIds = [x.id for x in definitions]
+            headers = page_headers(total, definitions, check_page)
+        reports = await analytics.get_analytics(orm_session, checkIds, since, until, bucket)
+        return status.HTTP_200_OK, [x.dict() for x in reports], headers
+    # without an explicit 'until' the window moves, which the cache's ttl bounds
+    topics = responses.result_topics(checkId) if checkId else ('definitions', 'results')
+    return await responses.cached(request, topics, build)
 
 @app.get('/notificationaddresses', response_model=List[validations.NotificationAddress])
-async def get_notification_addresses(response: Response, checkId: Optional[int] = None, 
+async def get_notification_addresses(request: Request, checkId: Optional[int] = None, 
+                                     id: Optional[List[int]] = Query(None),
+                                     page: validations.PageParams = Depends(get_page_params),
                                      orm_session: database.AsyncSession = Depends(get_orm_session),
                                      auth = Depends(security.has_auth)):
-    addresses = await crud.get_notification_addresses(orm_session, checkId)
-    response.headers['X-Total-Count'] = str(len(addresses))
-    return addresses
+    async def build():
+        addresses = await crud.get_notification_addresses(orm_session, checkId, id, page)
+        total = await crud.count_notification_addresses(orm_session, checkId, id)
+        return (status.HTTP_200_OK, 
+                [responses.to_dict(x, responses.ADDRESS_FIELDS) for x in addresses],
+                page_headers(total, addresses, page))
+    return await responses.cached(request, ('addresses',), build)
 
 @app.get('/notificationaddresses/{notificationId}', response_model=validations.NotificationAddress)
-async def get_notification_address_by_id(notificationId: int, 
+async def get_notification_address_by_id(notificationId: int, request: Request, 
                                          orm_session: database.AsyncSession = Depends(get_orm_session),
                                          auth = Depends(security.has_auth)):
-    address = await crud.get_notification_address_by_id(orm_session, notificationId)
-    return address
+    async def build():
+        address = await crud.get_notification_address_by_id(orm_session, notificationId)
+        if address is None:
+            return status.HTTP_200_OK, None, {}
+        return status.HTTP_200_OK, responses.to_dict(address, responses.ADDRESS_FIELDS), {}
+    return await responses.cached(request, ('addresses',), build)
 
 @app.post('/notificationaddresses', status_code=status.HTTP_201_CREATED)
 async def create_notification_address(address_definition: validations.NotificationAddressBase, 
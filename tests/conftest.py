@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# the settings the app requires, set before anything from core is imported
+for name, value in {'ADMIN_EMAIL': 'admin@example.com', 'SENDER_EMAIL': 'alerts@example.com',
+                    'SMTP_SERVER': 'localhost', 'SMTP_PORT': '25', 'SMTP_USERNAME': 'user',
+                    'SMTP_PASSWORD': 'password', 'BUILD_DIRECTORY': tempfile.gettempdir()}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from core import crud, models, validations
+from core.database import AsyncSession, Base
+
+# every other definition has no expectedString and every third no maxLatencyMs,
+# so pages end on NULL cursors as well as on values
+DEFINITIONS = [dict(url='http://example.com/{}'.format(i), frequency=60, expectedStatus=200,
+                    expectedString=None if i % 2 else 'text {}'.format(i % 4),
+                    maxLatencyMs=None if i % 3 == 0 else 100 * (i % 5))
+               for i in range(1, 24)]
+
+async def walk(session, sort: str, descending: bool, limit: int) -> list[int]:
+    """Ids in the order keyset pagination returns them, a page at a time"""
+    ids, after = [], None
+    while True:
+        page = validations.PageParams(limit=limit, sort=sort, descending=descending, 
+                                      after=after)
+        rows = await crud.get_check_defintions(session, page=page)
+        ids.extend(x.id for x in rows)
+        if len(rows) < limit:
+            return ids
+        after = rows[-1].id
+
+async def paginate(tmp_path, sort: str, descending: bool, limit: int):
+    engine = create_async_engine('sqlite+aiosqlite:///{}'.format(tmp_path / 'test.db'))
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.execute(insert(models.CheckDefinition.__table__), DEFINITIONS)
+    async with AsyncSession(engine) as session:
+        everything = validations.PageParams(limit=len(DEFINITIONS), sort=sort, 
+                                            descending=descending)
+        expected = [x.id for x in await crud.get_check_defintions(session, page=everything)]
+        walked = await walk(session, sort, descending, limit)
+    await engine.dispose()
+    return expected, walked
+
+@pytest.mark.parametrize('sort', ['expectedString', 'maxLatencyMs', 'id'])
+@pytest.mark.parametrize('descending', [False, True])
+@pytest.mark.parametrize('limit', [1, 2, 5])
+def test_keyset_pages_match_one_query(tmp_path, sort, descending, limit):
+    expected, walked = asyncio.run(paginate(tmp_path, sort, descending, limit))
+    assert walked == expected
+    assert sorted(walked) == list(range(1, len(DEFINITIONS) + 1))
+
+def test_nulls_sort_first_going_up(tmp_path):
+    expected, _ = asyncio.run(paginate(tmp_path, 'expectedString', False, 2))
+    nulls = [x['expectedString'] is None for x in DEFINITIONS]
+    assert expected[:sum(nulls)] == [i + 1 for i, null in enumerate(nulls) if null]
@@ -5,6 +5,8 @@ import { CreateButton, EditButton, DeleteButton, Filter } from "react-admin";
 const DefinitionFilter = (props) => (
     <Filter {...props}>
         <TextInput label="Search" source='urlcontains' alwaysOn />
+        <TextInput label="Host" source='hostcontains' />
+        <TextInput label="Path" source='pathcontains' />
     </Filter>
 )
 
@@ -16,6 +18,7 @@ export const CheckDefinitionList = (props) => (
             <NumberField source="frequency" />
             <NumberField source="expectedStatus" />
             <TextField source="expectedString" />
+            <NumberField source="maxLatencyMs" label="Max Latency (ms)" />
             <ReferenceManyField label='E-mail Addresses' reference='notificationaddresses' target="checkId">
                 <SingleFieldList>
                     <TextField source='emailAddress' />
@@ -32,6 +35,8 @@ export const CheckDefinitionEdit = (props) => (
             <NumberInput source="frequency" validate={required()}/>
             <NumberInput source="expectedStatus" validate={required()}/>
             <TextInput source="expectedString" />
+            <NumberInput source="maxLatencyMs" label="Max Latency (ms)" />
+            <NumberInput source="timeoutMs" label="Timeout (ms)" />
             <ReferenceManyField label='E-mail Addresses' reference='notificationaddresses' target="checkId">
                 <Datagrid>
                     <TextField source='emailAddress' />
@@ -51,6 +56,8 @@ export const CheckDefinitionCreate = (props) => (
             <NumberInput source="frequency" validate={required()}/>
             <NumberInput source="expectedStatus" validate={required()}/>
             <TextInput source="expectedString" />
+            <NumberInput source="maxLatencyMs" label="Max Latency (ms)" />
+            <NumberInput source="timeoutMs" label="Timeout (ms)" />
         </SimpleForm> 
     </Create>
 );
@@ -6,6 +6,7 @@ export const CheckResultList = (props) => (
             <UrlField source="checkDefinition.url" label='Check URL'/>
             <DateField source="timeChecked" showTime="true" />
             <NumberField source="statusCode" />
+            <NumberField source="latencyMs" label="Latency (ms)" />
             <TextField source="state" />
             <TextField source="id" />            
         </Datagrid>
@@ -4,6 +4,8 @@ import { UrlField, NumberField, TextField, DateField, TextInput } from "react-ad
 const DefinitionFilter = (props) => (
     <Filter {...props}>
         <TextInput label="Search" source='urlcontains' alwaysOn />
+        <TextInput label="Host" source='hostcontains' />
+        <TextInput label="Path" source='pathcontains' />
     </Filter>
 )
 
@@ -16,6 +18,7 @@ export const LatestResultList = (props) => (
             <TextField source="expectedString" emptyText='None'/>
             <DateField source="lastChecked" showTime="true" />
             <TextField source="lastState" />
+            <NumberField source="lastLatencyMs" label="Latency (ms)" />
         </Datagrid>
     </List>
 );